@@ -0,0 +1,334 @@
+# Benchmarks every Processing operation on generated media.
+#
+#   python -m bench.processing [-o results.json] [-k substring] [--compare old.json]
+#
+# Fixtures are generated once with ffmpeg's lavfi sources into bench/fixtures.
+# Every case runs in a fresh interpreter so peak RSS and CPU time belong to
+# that case alone, including ffmpeg children and vips work.
+import argparse
+import asyncio
+import concurrent.futures
+import datetime
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from dataclasses import dataclass
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+@dataclass
+class Fixture:
+    name: str
+    type: str
+    args: list
+
+    @property
+    def path(self) -> str:
+        ext = {"video": ".mp4", "gif": ".gif", "image": ".png"}[self.type]
+        return os.path.join(FIXTURE_DIR, self.name + ext)
+
+
+def video(name: str, size: str, duration: int) -> Fixture:
+    return Fixture(
+        name,
+        "video",
+        [
+            "-f", "lavfi", "-i", f"testsrc=size={size}:rate=30:duration={duration}",
+            "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}",
+            "-c:v", "libx264", "-pix_fmt", "yuv420p", "-c:a", "aac", "-shortest",
+        ],
+    )
+
+
+def gif(name: str, size: str, frames: int) -> Fixture:
+    return Fixture(
+        name,
+        "gif",
+        ["-f", "lavfi", "-i", f"testsrc=size={size}:rate=15", "-frames:v", str(frames)],
+    )
+
+
+def image(name: str, size: str) -> Fixture:
+    return Fixture(
+        name, "image", ["-f", "lavfi", "-i", f"testsrc=size={size}", "-frames:v", "1"]
+    )
+
+
+FIXTURES = {
+    f.name: f
+    for f in [
+        video("video-240p-5s", "320x240", 5),
+        video("video-720p-10s", "1280x720", 10),
+        video("video-1080p-30s", "1920x1080", 30),
+        gif("gif-240p-30f", "320x240", 30),
+        gif("gif-360p-150f", "480x360", 150),
+        gif("gif-240p-500f", "320x240", 500),
+        image("image-720p", "1280x720"),
+        image("image-1080p", "1920x1080"),
+    ]
+}
+
+# (case name, method, fixture names, extra arguments)
+CASES = [
+    ("meme/image-720p", "meme", ["image-720p"], ["top text", "bottom text"]),
+    ("meme/gif-360p-150f", "meme", ["gif-360p-150f"], ["top text", "bottom text"]),
+    ("meme/gif/gif-360p-150f", "meme", ["gif-360p-150f"], ["top", "bottom", "gif"]),
+    ("meme/mp4/gif-360p-150f", "meme", ["gif-360p-150f"], ["top", "bottom", "mp4"]),
+    ("meme/video-720p-10s", "meme", ["video-720p-10s"], ["top text", "bottom text"]),
+    ("meme/gif/video-240p-5s", "meme", ["video-240p-5s"], ["top", "bottom", "gif"]),
+    ("caption/image-1080p", "caption", ["image-1080p"], ["when the"]),
+    ("caption/gif-240p-30f", "caption", ["gif-240p-30f"], ["when the"]),
+    ("caption/gif-240p-500f", "caption", ["gif-240p-500f"], ["when the"]),
+    ("caption/gif/gif-240p-500f", "caption", ["gif-240p-500f"], ["when the", "gif"]),
+    ("gif/video-240p-5s", "gif", ["video-240p-5s"], []),
+    ("gif/video-720p-10s", "gif", ["video-720p-10s"], []),
+    ("loopvid/image-720p", "loopvid", ["image-720p"], [10]),
+    ("loopvid/gif-240p-30f", "loopvid", ["gif-240p-30f"], [10]),
+    ("loopvid/video-240p-5s", "loopvid", ["video-240p-5s"], [20]),
+    ("cut/video-720p-10s", "cut", ["video-720p-10s", "video-240p-5s"], [3]),
+    ("stack/video-720p-10s", "stack", ["vstack", "video-720p-10s", "video-240p-5s"], []),
+    ("stitch/video-720p-10s", "stack", ["hstack", "video-720p-10s", "video-240p-5s"], []),
+    ("crop/video-720p-10s", "crop", ["video-720p-10s"], ["top", 100]),
+    ("crop/video-1080p-30s", "crop", ["video-1080p-30s"], ["left", 200]),
+    ("edit/speed/video-720p-10s", "edit", ["video-720p-10s"], ["speed 2"]),
+    ("edit/reverse/video-240p-5s", "edit", ["video-240p-5s"], ["reverse"]),
+    ("edit/volume/video-1080p-30s", "edit", ["video-1080p-30s"], ["volume 0.5"]),
+    ("first_frame/video-1080p-30s", "first_frame", ["video-1080p-30s"], []),
+    ("first_frame/gif-240p-500f", "first_frame", ["gif-240p-500f"], []),
+    ("chain/video-720p-10s", "chain", ["video-720p-10s"], ['speed 2 | meme a b | gif']),
+    ("chain/gif-360p-150f", "chain", ["gif-360p-150f"], ["caption when | crop top 20"]),
+    ("meme/pool/video-240p-5s", "meme", ["video-240p-5s"], ["top", "bottom"]),
+]
+
+# Cases run through the real process pool rather than threads, so whatever
+# crosses the process boundary has to pickle. Their CPU time leaves out the
+# workers.
+POOL_CASES = {"meme/pool/video-240p-5s"}
+
+
+def load_pages(out):
+    import pyvips
+
+    if out.data is not None:
+        return pyvips.Image.new_from_buffer(out.data, "", n=-1)
+    return pyvips.Image.new_from_file(out.path, n=-1)
+
+
+def check_caption_crop(out, inputs: list) -> None:
+    """caption when | crop top 20 keeps every frame, adds the caption's
+    height to each and takes 20 px off the top."""
+    import pyvips
+    import util.vips as vips
+
+    source = pyvips.Image.new_from_file(inputs[0].name, n=-1)
+    image = load_pages(out)
+    page_height = source.get_page_height() + vips.caption(source.width, "when").height
+    expected = (source.get_n_pages(), source.width, page_height - 20)
+    got = (image.get_n_pages(), image.width, image.get_page_height())
+    if got != expected or image.height != got[0] * got[2]:
+        raise AssertionError(
+            f"Expected {expected} (pages, width, page height), got {got} "
+            f"with height {image.height}"
+        )
+
+
+def check_video_gif(out, inputs: list) -> None:
+    """A meme on a video with sound, asked for as a GIF, comes out as a GIF
+    at the tier's frame rate and size bound."""
+    import util.encode as encoding
+
+    tier = encoding.TIERS[0]
+    probe = inputs[0].probe
+    image = load_pages(out)
+    expected = (
+        ".gif",
+        round(probe.duration * min(tier.fps, 30)),
+        encoding.bound(probe.video.width, probe.video.height, tier.max_dimension),
+    )
+    got = (out.suffix, image.get_n_pages(), (image.width, image.get_page_height()))
+    # The last frame may be dropped or duplicated by the fps filter.
+    if got[0] != expected[0] or abs(got[1] - expected[1]) > 1 or got[2] != expected[2]:
+        raise AssertionError(f"Expected {expected} (suffix, pages, size), got {got}")
+
+
+# Output checks by case, called with the output and the input files.
+CHECKS = {
+    "chain/gif-360p-150f": check_caption_crop,
+    "meme/gif/video-240p-5s": check_video_gif,
+}
+
+
+def ensure_fixture(fixture: Fixture) -> str:
+    if not os.path.exists(fixture.path):
+        os.makedirs(FIXTURE_DIR, exist_ok=True)
+        subprocess.run(
+            ["ffmpeg", "-y", "-loglevel", "error", *fixture.args, fixture.path],
+            check=True,
+        )
+    return fixture.path
+
+
+def usage() -> tuple[float, int]:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+    return cpu, max(own.ru_maxrss, children.ru_maxrss)
+
+
+async def run_case(
+    method: str, names: list, args: list, pool: bool = False, check=None
+) -> dict:
+    import processing
+    import util.cache as cache
+    import util.ffmpeg as ffutil
+    import util.pool
+    import util.trace as trace
+
+    if pool:
+        executor = util.pool.WorkerPool(2)
+    else:
+        # Threads keep vips CPU time and memory inside this process's rusage.
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())
+    proc = processing.Processing(executor, asyncio.get_running_loop())
+    positional = []
+    for name in names:
+        fixture = FIXTURES.get(name)
+        if fixture is None:
+            positional.append(name)
+            continue
+        digest = cache.hash_file(fixture.path)
+        probe = await ffutil.probe(fixture.path, digest)
+        positional.append(processing.File(fixture.path, fixture.type, digest, probe))
+    if method == "edit":
+        args = [processing.parse_edits(args[0])]
+    elif method == "chain":
+        args = [processing.parse_chain(args[0])]
+    # The trace picks up the cost model's estimate, for cost.calibrate().
+    token = trace.start(method)
+    try:
+        out = await getattr(proc, method)(*positional, *args)
+    finally:
+        executor.shutdown()
+    attrs = trace.current.get().attrs
+    trace.finish(token)
+    try:
+        if check is not None:
+            check(out, positional)
+    finally:
+        if out.path is not None:
+            os.remove(out.path)
+    return {
+        "output_bytes": out.size,
+        "plan": out.plan,
+        "cost_op": attrs.get("cost_op"),
+        "cost_work": attrs.get("cost_work"),
+    }
+
+
+def child(case: str) -> None:
+    _, method, names, args = next(c for c in CASES if c[0] == case)
+    cpu_before, _ = usage()
+    start = time.perf_counter()
+    result = asyncio.run(
+        run_case(method, names, args, case in POOL_CASES, CHECKS.get(case))
+    )
+    wall = time.perf_counter() - start
+    cpu_after, peak_rss = usage()
+    json.dump(
+        {
+            "case": case,
+            "method": method,
+            "wall_s": wall,
+            "cpu_s": cpu_after - cpu_before,
+            "peak_rss_kib": peak_rss,
+            **result,
+        },
+        sys.stdout,
+    )
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_path: str, results: list) -> None:
+    with open(old_path) as f:
+        old = {r["case"]: r for r in json.load(f)["results"]}
+    print(f"\n{'case':<32} {'wall':>16} {'cpu':>16} {'rss':>16}")
+    for r in results:
+        prev = old.get(r["case"])
+        if prev is None or "error" in prev or "error" in r:
+            continue
+        cols = []
+        for key in ["wall_s", "cpu_s", "peak_rss_kib"]:
+            delta = (r[key] - prev[key]) / prev[key] * 100 if prev[key] else 0
+            cols.append(f"{r[key]:>8.2f} ({delta:+.0f}%)")
+        print(f"{r['case']:<32} {cols[0]:>16} {cols[1]:>16} {cols[2]:>16}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", default="bench_output.json")
+    parser.add_argument("-k", "--filter", default="", help="only run matching cases")
+    parser.add_argument("--compare", help="earlier results file to diff against")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.case:
+        child(args.case)
+        return
+
+    cases = [c for c in CASES if args.filter in c[0]]
+    for _, _, names, _ in cases:
+        for name in names:
+            if name in FIXTURES:
+                ensure_fixture(FIXTURES[name])
+
+    results = []
+    for case, *_ in cases:
+        proc = subprocess.run(
+            [sys.executable, "-m", "bench.processing", "--case", case],
+            capture_output=True,
+            text=True,
+        )
+        if proc.returncode != 0:
+            result = {"case": case, "error": proc.stderr.strip().splitlines()[-1:]}
+            print(f"{case:<32} failed: {result['error']}")
+        else:
+            result = json.loads(proc.stdout)
+            print(
+                f"{case:<32} {result['wall_s']:>7.2f}s wall {result['cpu_s']:>7.2f}s cpu"
+                f" {result['peak_rss_kib'] / 1024:>7.1f} MiB"
+                f" {result['output_bytes'] / 1024:>8.1f} KiB"
+                f" {result['plan']}"
+            )
+        results.append(result)
+
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "revision": git_revision(),
+                "date": datetime.datetime.now().isoformat(),
+                "cpus": os.cpu_count(),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
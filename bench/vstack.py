@@ -0,0 +1,71 @@
+# Compares the caption frame stack against the old per-frame insert loop.
+#
+#   python -m bench.vstack [frames ...]
+import sys
+import time
+import pyvips
+from pyvips import GValue
+import util.vips as vips
+
+
+def animated(frames: int, width: int = 320, height: int = 240) -> pyvips.Image:
+    pages = [
+        (pyvips.Image.black(width, height, bands=3) + [i % 256, 64, 128]).cast("uchar")
+        for i in range(frames)
+    ]
+    img = pyvips.Image.arrayjoin(pages, across=1).copy()
+    img.set_type(GValue.gint_type, "page-height", height)
+    return img
+
+
+def vstack_insert(top: pyvips.Image, img: pyvips.Image) -> pyvips.Image:
+    if not img.hasalpha():
+        img = img.bandjoin(255)
+    page_height = img.get_page_height()
+    top = top.embed(0, 0, img.width, top.height + page_height, extend="black")
+    caption_height = top.height - page_height
+    replicated = top.replicate(1, img.get_n_pages())
+    for i in range(img.get_n_pages()):
+        frame = img.crop(0, i * page_height, img.width, page_height)
+        replicated = replicated.insert(frame, 0, i * top.height + caption_height)
+    replicated = replicated.copy()
+    replicated.set_type(GValue.gint_type, "page-height", top.height)
+    return replicated
+
+
+def measure(func, top: pyvips.Image, img: pyvips.Image) -> float:
+    start = time.perf_counter()
+    stacked = func(top, img)
+    stacked.write_to_memory()
+    elapsed = time.perf_counter() - start
+    page_height = top.height + img.get_page_height()
+    if (stacked.get_n_pages(), stacked.get_page_height()) != (
+        img.get_n_pages(),
+        page_height,
+    ) or stacked.height != page_height * img.get_n_pages():
+        raise AssertionError(
+            f"{func.__name__} made {stacked.get_n_pages()} pages of "
+            f"{stacked.get_page_height()}px, expected {img.get_n_pages()} of "
+            f"{page_height}px"
+        )
+    return elapsed
+
+
+def main(argv: list) -> None:
+    counts = [int(arg) for arg in argv] or [25, 50, 100, 200, 400]
+    top = vips.caption(320, "when the")
+    print(
+        f"{'frames':>6} {'arrayjoin':>10} {'per frame':>10} {'insert':>10} {'per frame':>10}"
+    )
+    for frames in counts:
+        img = animated(frames)
+        new = measure(vips.vstack, top, img)
+        old = measure(vstack_insert, top, img)
+        print(
+            f"{frames:>6} {new:>9.3f}s {new / frames * 1000:>8.2f}ms"
+            f" {old:>9.3f}s {old / frames * 1000:>8.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -46,7 +46,12 @@ class Cinnamon(AutoShardedBot):
         await super().start(config.token, reconnect=True)
 
     async def setup_hook(self) -> None:
-        self.session: aiohttp.ClientSession = aiohttp.ClientSession()
+        self.session: aiohttp.ClientSession = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=getattr(config, "http_connections", 100),
+                limit_per_host=getattr(config, "http_connections_per_host", 8),
+            )
+        )
         self.bot_app_info = await self.application_info()
         self.owner_id = self.bot_app_info.owner.id
         for extension in initial_extensions:
@@ -2,36 +2,86 @@ from bot import Cinnamon
 from discord.ext import commands
 import discord
 import magic
-import concurrent.futures
 import processing
-import functools
 import os
 import mimetypes
 import tempfile
 import processing
-import requests
+import aiohttp
+import asyncio
 import util.ffmpeg as ffutil
 import typing
 import contextlib
-
-
-async def media_from_message(
-    ctx: commands.Context, message: discord.Message
-) -> str | None:
+import io
+import time
+import hashlib
+import config
+import util.cache as cache
+import util.encode as encoding
+import util.tmpfile as tmpfile
+import util.scheduler as scheduler
+import util.trace as trace
+import util.pool as pool
+import util.music as musicutil
+import util.recent as recent
+import util.gifv as gifv
+import util.cost as cost
+import util.remote as remote
+from aiohttp import web
+from dataclasses import dataclass
+
+
+# How many messages before a command are searched for media.
+HISTORY_LIMIT = 50
+
+
+@dataclass(frozen=True)
+class Media:
+    url: str
+    # gifv embeds link to a page that the media still has to be found in.
+    gifv: bool = False
+    provider: typing.Optional[str] = None
+    # The MP4 rendition of a gifv, when the embed already has it.
+    video: typing.Optional[str] = None
+
+
+def message_media(message: discord.Message) -> typing.Optional[Media]:
     for attachment in message.attachments:
         if attachment.height:
-            return attachment.url
+            return Media(attachment.url)
     for embed in message.embeds:
         if embed.type == "video" and not embed.provider:
-            return embed.url
+            return Media(embed.url)
         if embed.type == "image":
-            return embed.thumbnail.proxy_url
+            return Media(embed.thumbnail.proxy_url)
         if embed.type == "gifv":
-            if embed.url.startswith("https://tenor.com"):
-                resp = await ctx.bot.session.get(embed.url)
-                body = await resp.text()
-                return body.split('rel="image_src" href="')[1].split('"')[0]
-            raise commands.BadArgument(f"TODO: gifv {embed.provider.name}")
+            return Media(embed.url, True, embed.provider.name, embed.video.url)
+    return None
+
+
+async def resolve_media(
+    ctx: commands.Context, media: Media, allowed_types: typing.Optional[list] = None
+) -> str:
+    if not media.gifv:
+        return media.url
+    # Most gifv embeds carry the MP4 already, which saves loading the page.
+    if url := gifv.Renditions(media.video).pick(allowed_types):
+        return url
+    try:
+        renditions = await ctx.bot.get_cog("Processing").gifv.resolve(media.url)
+    except gifv.GifvError as e:
+        raise commands.BadArgument(f"Couldn't use {media.provider or 'the'} GIF: {e}")
+    # Falls back to the MP4 so the download reports which type was wrong.
+    return renditions.pick(allowed_types) or renditions.video
+
+
+async def media_from_message(
+    ctx: commands.Context,
+    message: discord.Message,
+    allowed_types: typing.Optional[list] = None,
+) -> str | None:
+    if media := message_media(message):
+        return await resolve_media(ctx, media, allowed_types)
     return None
 
 
@@ -62,29 +112,88 @@ def mime_to_media_type(mime: str) -> str:
                 raise DisallowedMediaError(mime)
 
 
-def input(url: str, allowed_types: list) -> processing.File:
-    mtype = mimetypes.guess_type(url)[0]
-    if type := mime_to_media_type(mtype) not in allowed_types:
-        raise DisallowedMediaError(type, allowed_types)
-    with requests.get(url, stream=True) as resp:
-        resp.raise_for_status()
-        first = next(resp.iter_content(chunk_size=512))
-        mime = magic.detect_from_content(first)
-        if type := mime_to_media_type(mime.mime_type) not in allowed_types:
+class TooLargeError(Exception):
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+
+    def __str__(self) -> str:
+        return f"Media is larger than {self.limit // (1 << 20)} MiB."
+
+
+class Downloader:
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        download_cache: cache.DiskCache,
+        max_bytes: int,
+        max_concurrent: int,
+    ) -> None:
+        self.session = session
+        self.cache = download_cache
+        self.max_bytes = max_bytes
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def input(self, url: str, allowed_types: list) -> processing.File:
+        f = await self.fetch(url, allowed_types)
+        try:
+            f.probe = await ffutil.probe(f.name, f.digest)
+        except BaseException as e:
+            os.remove(f.name)
+            raise e
+        attrs = {"input_bytes": os.path.getsize(f.name), "input_type": f.type}
+        if video := f.probe.video:
+            attrs["width"], attrs["height"] = video.width, video.height
+        trace.annotate(**attrs)
+        return f
+
+    async def fetch(self, url: str, allowed_types: list) -> processing.File:
+        mtype = mimetypes.guess_type(url)[0]
+        if mtype and (type := mime_to_media_type(mtype)) not in allowed_types:
             raise DisallowedMediaError(type, allowed_types)
-        with tempfile.NamedTemporaryFile(delete=False) as f:
-            try:
-                f.write(first)
-                written = len(first)
-                for chunk in resp.iter_content(4096):
-                    written += len(chunk)
-                    f.write(chunk)
-                f.close()
-                return processing.File(f.name, mime_to_media_type(mime.mime_type))
-            except Exception as e:
-                f.close()
-                os.remove(f.name)
-                raise e
+        key = "url:" + cache.normalize_url(url)
+        if entry := self.cache.lookup(key):
+            if entry.meta["type"] not in allowed_types:
+                raise DisallowedMediaError(entry.meta["type"], allowed_types)
+            name = tmpfile.unused("")
+            if self.cache.checkout(entry, name):
+                return processing.File(name, entry.meta["type"], entry.digest)
+        async with self.semaphore:
+            with trace.span("download"):
+                return await self.download(url, key, allowed_types)
+
+    async def download(
+        self, url: str, key: str, allowed_types: list
+    ) -> processing.File:
+        async with self.session.get(url) as resp:
+            resp.raise_for_status()
+            if resp.content_length and resp.content_length > self.max_bytes:
+                raise TooLargeError(self.max_bytes)
+            first = b""
+            while len(first) < 512 and (chunk := await resp.content.read(512)):
+                first += chunk
+            mime = magic.detect_from_content(first)
+            if (type := mime_to_media_type(mime.mime_type)) not in allowed_types:
+                raise DisallowedMediaError(type, allowed_types)
+            with tempfile.NamedTemporaryFile(delete=False) as f:
+                try:
+                    h = hashlib.sha256(first)
+                    f.write(first)
+                    written = len(first)
+                    async for chunk in resp.content.iter_chunked(1 << 16):
+                        written += len(chunk)
+                        if written > self.max_bytes:
+                            raise TooLargeError(self.max_bytes)
+                        h.update(chunk)
+                        f.write(chunk)
+                    f.close()
+                    entry = await asyncio.to_thread(
+                        self.cache.put_file, f.name, key, {"type": type}, h.hexdigest()
+                    )
+                    return processing.File(f.name, type, entry.digest)
+                except BaseException as e:
+                    f.close()
+                    os.remove(f.name)
+                    raise e
 
 
 def URL(argument: str) -> str:
@@ -101,23 +210,51 @@ def Edits(argument: str) -> processing.Edits:
     return edits
 
 
-async def find_input(ctx: commands.Context) -> typing.Optional[str]:
-    if media := await media_from_message(ctx, ctx.message):
-        return media
-    if ctx.message.reference:
-        message = await ctx.channel.fetch_message(ctx.message.reference.message_id)
-        if media := await media_from_message(ctx, message):
-            return media
-    async for message in ctx.channel.history(
-        limit=50, oldest_first=False, before=ctx.message
-    ):
-        if media := await media_from_message(ctx, message):
-            return media
+# Animated results are WebP or MP4 unless one of these is given.
+OutputFormat = typing.Literal["gif", "webp", "mp4"]
 
 
-async def ensure_input_url(ctx: commands.Context, input: typing.Optional[str]) -> str:
+def Chain(argument: str) -> tuple:
+    try:
+        steps = processing.parse_chain(argument)
+    except processing.ParseError as e:
+        raise commands.BadArgument(str(e))
+    return steps
+
+
+async def find_input(
+    ctx: commands.Context, allowed_types: typing.Optional[list] = None
+) -> typing.Optional[str]:
+    if media := await media_from_message(ctx, ctx.message, allowed_types):
+        return media
+    if ref := ctx.message.reference:
+        message = ref.resolved
+        if message is None and ref.message_id is not None:
+            message = await ctx.channel.fetch_message(ref.message_id)
+        if isinstance(message, discord.Message):
+            if media := await media_from_message(ctx, message, allowed_types):
+                return media
+    index = ctx.bot.get_cog("Processing").recent
+    if media := index.latest(ctx.channel.id, ctx.message.id):
+        return await resolve_media(ctx, media, allowed_types)
+    # Only read the history the index didn't see, which after a cold start is
+    # whatever was sent before the channel's first message since.
+    before, limit = index.missing(ctx.channel.id, ctx.message.id, HISTORY_LIMIT)
+    if limit:
+        async for message in ctx.channel.history(
+            limit=limit, oldest_first=False, before=discord.Object(before)
+        ):
+            if media := await media_from_message(ctx, message, allowed_types):
+                return media
+
+
+async def ensure_input_url(
+    ctx: commands.Context,
+    input: typing.Optional[str],
+    allowed_types: typing.Optional[list] = None,
+) -> str:
     if input is None:
-        input = await find_input(ctx)
+        input = await find_input(ctx, allowed_types)
         if input is None:
             raise commands.BadArgument("No media found")
     return input
@@ -128,36 +265,130 @@ def cleanup(files):
         os.remove(file)
 
 
+# shows and updates a "you're #N in queue" reply while a job waits
+class QueueNotice:
+    def __init__(self, ctx: commands.Context):
+        self.ctx = ctx
+        self.message: typing.Optional[discord.Message] = None
+        self.position = 0
+        self.task: typing.Optional[asyncio.Task] = None
+        # Set while the job isn't queued.
+        self.running = asyncio.Event()
+        # Waits shorter than this don't get a notice at all.
+        self.delay = getattr(config, "queue_notice_delay", 1.5)
+
+    def update(self, position: int):
+        self.position = position
+        if position == 0:
+            self.running.set()
+        else:
+            self.running.clear()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.sync())
+
+    async def sync(self):
+        if self.message is None and self.position != 0:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.running.wait(), self.delay)
+        shown = None
+        while shown != self.position:
+            shown = self.position
+            with contextlib.suppress(discord.HTTPException):
+                if shown == 0:
+                    if self.message is not None:
+                        await self.message.delete()
+                        self.message = None
+                elif self.message is None:
+                    self.message = await self.ctx.reply(f"You're #{shown} in queue")
+                else:
+                    await self.message.edit(content=f"You're #{shown} in queue")
+
+    async def close(self):
+        self.update(0)
+        await self.task
+
+
 # context manager to delete multiple temporary files
 class Working:
     def __init__(self, ctx: commands.Context):
         self.ctx = ctx
-        self.exec = ctx.bot.get_cog("Processing").executor
+        self.cog = ctx.bot.get_cog("Processing")
         self.files = []
+        self.notice = QueueNotice(ctx)
+        # Remote jobs wait in the workers' queues, which don't report a
+        # position, so the local scheduler's would always be misleading.
+        self.job = scheduler.Job(
+            ctx.guild.id if ctx.guild else None,
+            ctx.author.id,
+            None if self.cog.remote else self.notice.update,
+        )
+        self.task = None
+        self.timer = None
+        self.cancel_reason = None
 
     async def __aenter__(self):
+        self.trace_token = trace.start(self.ctx.command.qualified_name)
+        self.task = asyncio.current_task()
+        self.cog.working[self.ctx.message.id] = self
+        if timeout := getattr(config, "job_timeout", 300):
+            self.job.deadline = time.monotonic() + timeout
+            self.timer = asyncio.get_running_loop().call_later(
+                timeout, self.cancel, "deadline"
+            )
         self.typing = self.ctx.typing()
         await self.typing.__aenter__()
+        self.job_token = scheduler.current_job.set(self.job)
         return self
 
+    def cancel(self, reason: str):
+        """Cancels the command, which kills its ffmpeg processes and gives
+        up its scheduler slot on the way out."""
+        if self.cancel_reason is None:
+            self.cancel_reason = reason
+            self.task.cancel(reason)
+
     async def __aexit__(self, exc_type, exc_value, traceback):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.cog.working.pop(self.ctx.message.id, None)
+        scheduler.current_job.reset(self.job_token)
+        cancelled = self.cancel_reason is not None
+        if cancelled:
+            self.task.uncancel()
+            ffutil.scheduler.cancelled(self.cancel_reason)
+            trace.annotate(cancelled=self.cancel_reason)
+        await self.notice.close()
         await self.typing.__aexit__(exc_type, exc_value, traceback)
-        await self.ctx.bot.loop.run_in_executor(
-            self.exec, functools.partial(cleanup, self.files)
-        )
+        with trace.span("cleanup"):
+            cleanup(self.files)
+        trace.finish(self.trace_token, exc_value)
+        if self.cancel_reason == "deadline":
+            with contextlib.suppress(discord.HTTPException):
+                await self.ctx.reply("This took too long, so it was cancelled")
+        # Swallow our own cancellation so it doesn't look like an error.
+        return cancelled and exc_type is asyncio.CancelledError
 
     def append(self, file: str):
         self.files.append(file)
 
+    async def reply(self, out: processing.Output):
+        if out.data is not None:
+            file = discord.File(io.BytesIO(out.data), out.filename)
+        else:
+            self.append(out.path)
+            file = discord.File(out.path, out.filename)
+        trace.annotate(plan=out.plan)
+        with trace.span("upload", output_bytes=out.size):
+            await self.ctx.reply(file=file)
+
     async def input(
         self, url: typing.Optional[str], allowed_types: list
     ) -> processing.File:
-        url = await ensure_input_url(self.ctx, url)
+        with trace.span("find_input"):
+            url = await ensure_input_url(self.ctx, url, allowed_types)
         try:
-            f = await self.ctx.bot.loop.run_in_executor(
-                self.exec, functools.partial(input, url, allowed_types)
-            )
-        except DisallowedMediaError as e:
+            f = await self.cog.downloader.input(url, allowed_types)
+        except (DisallowedMediaError, TooLargeError) as e:
             raise commands.BadArgument(str(e))
         self.append(f.name)
         return f
@@ -166,8 +397,119 @@ class Working:
 class Processing(commands.Cog):
     def __init__(self, bot: Cinnamon):
         self.bot = bot
-        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=4)
-        self.processing = processing.Processing(self.executor, self.bot.loop)
+        ffutil.scheduler.configure(getattr(config, "max_jobs", os.cpu_count() or 4))
+        self.download_cache = cache.DiskCache(
+            getattr(
+                config,
+                "download_cache_dir",
+                os.path.join(tempfile.gettempdir(), "cinnamon", "downloads"),
+            ),
+            getattr(config, "download_cache_bytes", 1 << 30),
+        )
+        self.downloader = Downloader(
+            self.bot.session,
+            self.download_cache,
+            getattr(config, "max_download_bytes", 100 << 20),
+            getattr(config, "max_concurrent_downloads", 8),
+        )
+        self.executor: typing.Optional[pool.WorkerPool] = None
+        self.remote = False
+        if addresses := getattr(config, "remote_workers", None):
+            # Rendering happens on worker nodes (see worker.py), this process
+            # only downloads inputs and uploads results.
+            self.remote = True
+            self.processing = remote.RemoteProcessing(
+                addresses,
+                getattr(config, "in_memory_output", True),
+                getattr(config, "remote_worker_token", None),
+            )
+        else:
+            self.executor = pool.WorkerPool(
+                getattr(config, "workers", None),
+                getattr(config, "workers_per_core", 1.0),
+                getattr(config, "vips_concurrency", 1),
+                getattr(config, "vips_cache_max", 100),
+                getattr(config, "vips_cache_max_mem", 64 << 20),
+            )
+            self.result_cache = cache.DiskCache(
+                getattr(
+                    config,
+                    "result_cache_dir",
+                    os.path.join(tempfile.gettempdir(), "cinnamon", "results"),
+                ),
+                getattr(config, "result_cache_bytes", 1 << 30),
+            )
+            self.music_cache = cache.DiskCache(
+                getattr(
+                    config,
+                    "music_cache_dir",
+                    os.path.join(tempfile.gettempdir(), "cinnamon", "music"),
+                ),
+                getattr(config, "music_cache_bytes", 1 << 30),
+            )
+            model = cost.Model()
+            if path := getattr(config, "cost_calibration", None):
+                model = cost.Model(cost.calibrate(path))
+            budget = cost.Budget(
+                getattr(config, "job_cpu_budget", 120.0),
+                getattr(config, "job_memory_budget", 1 << 30),
+                getattr(config, "job_defer_cpu", 30.0),
+            )
+            self.processing = processing.Processing(
+                self.executor,
+                self.bot.loop,
+                self.result_cache,
+                getattr(config, "in_memory_output", True),
+                getattr(config, "upload_limit", 10 << 20),
+                musicutil.Music(self.music_cache, getattr(config, "music_ttl", 3600)),
+                budget,
+                model,
+            )
+        self.gifv = gifv.Resolver(bot.session, getattr(config, "gifv_ttl", 3600))
+        self.recent: recent.RecentMedia[Media] = recent.RecentMedia(
+            getattr(config, "recent_media_per_channel", 16)
+        )
+        # Commands in progress by the ID of the message that invoked them.
+        self.working: dict[int, Working] = {}
+
+    async def cog_load(self):
+        if self.executor is not None:
+            self.executor.start()
+        else:
+            self.processing.start()
+        self.metrics: typing.Optional[web.AppRunner] = None
+        if port := getattr(config, "metrics_port", None):
+            app = web.Application()
+            app.router.add_get("/metrics", self.serve_metrics)
+            self.metrics = web.AppRunner(app)
+            await self.metrics.setup()
+            await web.TCPSite(self.metrics, "127.0.0.1", port).start()
+
+    async def cog_unload(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        else:
+            self.processing.shutdown()
+        if self.metrics is not None:
+            await self.metrics.cleanup()
+
+    async def serve_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=trace.prometheus())
+
+    @commands.Cog.listener()
+    async def on_message(self, message: discord.Message):
+        self.recent.add(message.channel.id, message.id, message_media(message))
+
+    @commands.Cog.listener()
+    async def on_message_edit(self, before: discord.Message, after: discord.Message):
+        # Link embeds usually show up in an edit shortly after the message.
+        self.recent.update(after.channel.id, after.id, message_media(after))
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        self.recent.remove(payload.channel_id, payload.message_id)
+        if working := self.working.get(payload.message_id):
+            working.cancel("message deleted")
 
     async def cog_command_error(
         self, ctx: commands.Context, error: commands.CommandError
@@ -178,9 +520,7 @@ class Processing(commands.Cog):
             await ctx.send(str(error), ephemeral=True)
 
     async def input(self, url: str, allowed_types: list) -> processing.File:
-        return await self.bot.loop.run_in_executor(
-            self.executor, functools.partial(input, url, allowed_types)
-        )
+        return await self.downloader.input(url, allowed_types)
 
     async def cog_command_error(
         self, ctx: commands.Context, error: commands.CommandError
@@ -192,22 +532,59 @@ class Processing(commands.Cog):
         async with Working(ctx) as files:
             input1 = await files.input(url1, ["image", "video", "gif", "gifv"])
             input2 = await files.input(url2, ["image", "video", "gif", "gifv"])
-            fname = await self.processing.stack(method, input1, input2)
-            files.append(fname)
-            await ctx.reply(file=discord.File(fname))
+            out = await self.processing.stack(method, input1, input2)
+            await files.reply(out)
 
     @commands.command(name="probe")
     async def probe(self, ctx: commands.Context, url: typing.Optional[URL]):
         url = await ensure_input_url(ctx, url)
         probed = await ffutil.probe(url)
         reply = ""
-        for stream in probed["streams"]:
-            if stream["codec_type"] == "video":
-                reply += f"Video: {stream['codec_name']} {stream['width']}x{stream['height']} {stream['avg_frame_rate']}fps {stream['duration']}s\n"
-            elif stream["codec_type"] == "audio":
-                reply += f"Audio: {stream['codec_name']} {stream['sample_rate']}Hz {stream['duration']}s\n"
+        if video := probed.video:
+            reply += f"Video: {video.codec} {video.width}x{video.height} {video.frame_rate}fps {video.duration}s\n"
+        if audio := probed.audio:
+            reply += f"Audio: {audio.codec} {audio.sample_rate}Hz {audio.duration}s\n"
         await ctx.reply(reply)
 
+    @commands.command(name="queue")
+    async def queue(self, ctx: commands.Context):
+        if self.remote:
+            # Worker addresses stay out of the reply, it's visible to anyone.
+            lines = []
+            for i, worker in enumerate(self.processing.workers, 1):
+                if not worker.up():
+                    lines.append(f"Worker {i}: down")
+                    continue
+                lines.append(
+                    f"Worker {i}: {worker.load} jobs for {worker.limit} slots, "
+                    f"{worker.inflight} from here"
+                )
+            await ctx.reply("\n".join(lines))
+            return
+        stats = ffutil.scheduler.stats()
+        await ctx.reply(
+            f"Running: {stats.running}/{stats.limit}\n"
+            f"Queued: {stats.queued} ({stats.queued_by_priority['image']} image, "
+            f"{stats.queued_by_priority['video']} video, "
+            f"{stats.queued_by_priority['bulk']} bulk)\n"
+            f"Wait: {stats.mean_wait:.1f}s mean, {stats.max_wait:.1f}s max\n"
+            f"Cancelled: {sum(stats.cancelled.values())}\n"
+            f"Quality: {encoding.TIERS[stats.quality_level].name}"
+        )
+
+    @commands.command(name="latency")
+    @commands.is_owner()
+    async def latency(self, ctx: commands.Context, command: typing.Optional[str]):
+        lines = []
+        for (name, stage), h in sorted(trace.histograms.items()):
+            if command is not None and name != command:
+                continue
+            lines.append(
+                f"{name} {stage}: n={h.count} p50<={h.quantile(0.5)}s "
+                f"p99<={h.quantile(0.99)}s mean={h.sum / h.count:.2f}s"
+            )
+        await ctx.reply("\n".join(lines) or "No commands traced yet")
+
     @commands.command(name="crop")
     async def crop(
         self,
@@ -218,24 +595,22 @@ class Processing(commands.Cog):
     ):
         async with Working(ctx) as files:
             input = await files.input(url, ["video"])
-            fname = await self.processing.crop(input, direction, amount)
-            files.append(fname)
-            await ctx.reply(file=discord.File(fname))
+            out = await self.processing.crop(input, direction, amount)
+            await files.reply(out)
 
     @commands.command(name="firstframe")
     async def firstframe(self, ctx: commands.Context, url: typing.Optional[URL]):
         async with Working(ctx) as files:
             input = await files.input(url, ["video", "gif"])
-            fname = await self.processing.first_frame(input)
-            await ctx.reply(file=discord.File(fname))
+            out = await self.processing.first_frame(input)
+            await files.reply(out)
 
     @commands.command(name="gif")
     async def gif(self, ctx: commands.Context, url: typing.Optional[URL]):
         async with Working(ctx) as files:
             input = await files.input(url, ["video"])
-            fname = await self.processing.gif(input)
-            files.append(fname)
-            await ctx.reply(file=discord.File(fname))
+            out = await self.processing.gif(input)
+            await files.reply(out)
 
     @commands.command(name="loop")
     async def loop(
@@ -243,9 +618,8 @@ class Processing(commands.Cog):
     ):
         async with Working(ctx) as files:
             input = await files.input(url, ["video", "image", "gif"])
-            fname = await self.processing.loopvid(input, duration)
-            files.append(fname)
-            await ctx.reply(file=discord.File(fname))
+            out = await self.processing.loopvid(input, duration)
+            await files.reply(out)
 
     @commands.command(name="cut")
     async def cut(
@@ -258,9 +632,8 @@ class Processing(commands.Cog):
         async with Working(ctx) as files:
             input1 = await files.input(url1, ["video", "gif", "gifv"])
             input2 = await files.input(url2, ["video", "gif", "gifv"])
-            fname = await self.processing.cut(input1, input2, delay)
-            files.append(fname)
-            await ctx.reply(file=discord.File(fname))
+            out = await self.processing.cut(input1, input2, delay)
+            await files.reply(out)
 
     @commands.command(name="stitch")
     async def stitch(self, ctx: commands.Context, url1: URL, url2: URL):
@@ -272,23 +645,30 @@ class Processing(commands.Cog):
 
     @commands.command(name="meme")
     async def meme(
-        self, ctx: commands.Context, media: typing.Optional[URL], top: str, bottom: str
+        self,
+        ctx: commands.Context,
+        media: typing.Optional[URL],
+        top: str,
+        bottom: str,
+        format: typing.Optional[OutputFormat] = None,
     ):
         async with Working(ctx) as files:
             input = await files.input(media, ["image", "gif", "gifv", "video"])
-            fname = await self.processing.meme(input, top, bottom)
-            files.append(fname)
-            await ctx.reply(file=discord.File(fname))
+            out = await self.processing.meme(input, top, bottom, format)
+            await files.reply(out)
 
     @commands.command(name="caption")
     async def caption(
-        self, ctx: commands.Context, media: typing.Optional[URL], caption: str
+        self,
+        ctx: commands.Context,
+        media: typing.Optional[URL],
+        caption: str,
+        format: typing.Optional[OutputFormat] = None,
     ):
         async with Working(ctx) as files:
             input = await files.input(media, ["image", "gif"])
-            fname = await self.processing.caption(input, caption)
-            files.append(fname)
-            await ctx.reply(file=discord.File(fname))
+            out = await self.processing.caption(input, caption, format)
+            await files.reply(out)
 
     @commands.command(name="edit")
     async def edit(
@@ -296,9 +676,17 @@ class Processing(commands.Cog):
     ):
         async with Working(ctx) as files:
             input = await files.input(media, ["video"])
-            fname = await self.processing.edit(input, edits)
-            files.append(fname)
-            await ctx.reply(file=discord.File(fname))
+            out = await self.processing.edit(input, edits)
+            await files.reply(out)
+
+    @commands.command(name="chain")
+    async def chain(
+        self, ctx: commands.Context, media: typing.Optional[URL], *, steps: Chain
+    ):
+        async with Working(ctx) as files:
+            input = await files.input(media, ["image", "gif", "gifv", "video"])
+            out = await self.processing.chain(input, steps)
+            await files.reply(out)
 
 
 async def setup(bot: Cinnamon) -> None:
@@ -1,9 +1,8 @@
 import os
-import datetime
 import discord.ext.commands as commands
 import util.vips as vips
 import pyvips
-from typing import Optional, Callable, Any, Tuple
+from typing import Optional, Callable, Any, Tuple, Awaitable
 import asyncio
 import ffmpeg
 import util.ffmpeg as ffutil
@@ -13,7 +12,21 @@ import util.vips as vips
 import asyncio
 from dataclasses import dataclass
 import util.tmpfile as tmpfile
-import yt_dlp
+import util.cache as cache
+import util.encode as encoding
+from util.scheduler import Priority, time_left
+import util.trace as trace
+import dataclasses
+import json
+import contextlib
+import contextvars
+import util.music as musicutil
+import util.streamcopy as streamcopy
+import util.cost as cost
+from util.graph import Graph, MissingStreamError
+import math
+import shlex
+import time
 
 
 @dataclass
@@ -94,7 +107,7 @@ def parse_edit(edits: Edits, cmd: str, arg: str) -> Edits:
     elif cmd == "start":
         edits.start = parse_timestamp(arg)
     elif cmd == "end":
-        edits.start = parse_timestamp(arg)
+        edits.end = parse_timestamp(arg)
     else:
         raise ParseError(f"Unknown command")
     return edits
@@ -103,7 +116,6 @@ def parse_edit(edits: Edits, cmd: str, arg: str) -> Edits:
 def parse_edits(args: str) -> Edits:
     edits = Edits()
     commands = [split_command(cmd) for cmd in args.split(",")]
-    print(commands)
     seen = set()
     for cmd, _ in commands:
         if cmd in seen:
@@ -117,217 +129,1001 @@ def parse_edits(args: str) -> Edits:
     return edits
 
 
+EDIT_COMMANDS = {
+    "music",
+    "musicskip",
+    "musicdelay",
+    "musicvolume",
+    "volume",
+    "speed",
+    "vreverse",
+    "areverse",
+    "reverse",
+    "mute",
+    "start",
+    "end",
+}
+MAX_CHAIN_STEPS = 8
+
+
+@dataclass(frozen=True)
+class Step:
+    op: str
+    args: tuple = ()
+
+
+def parse_step(tokens: list) -> Step:
+    if not tokens:
+        raise ParseError("Empty step")
+    op, args = tokens[0], tokens[1:]
+    if op == "edit" or op in EDIT_COMMANDS:
+        edits = parse_edits(" ".join(args if op == "edit" else tokens))
+        if edits.music:
+            raise ParseError("music can't be used in a chain")
+        return Step("edit", (edits,))
+    if op == "meme":
+        if not 1 <= len(args) <= 2 or not any(args):
+            raise ParseError("meme takes top text and optional bottom text")
+        return Step("meme", (args[0], args[1] if len(args) == 2 else ""))
+    if op == "caption":
+        if not args:
+            raise ParseError("caption takes a caption")
+        return Step("caption", (" ".join(args),))
+    if op == "crop":
+        if len(args) != 2 or args[0] not in ["top", "bottom", "left", "right"]:
+            raise ParseError("crop takes a direction and an amount")
+        try:
+            return Step("crop", (args[0], int(args[1])))
+        except ValueError:
+            raise ParseError(f"Invalid number {args[1]}")
+    if op == "gif":
+        if args:
+            raise ParseError("gif takes no arguments")
+        return Step("gif")
+    raise ParseError(f"Unknown step '{op}'")
+
+
+def parse_chain(chain: str) -> Tuple[Step, ...]:
+    lexer = shlex.shlex(chain, posix=True, punctuation_chars="|")
+    lexer.whitespace_split = True
+    groups = [[]]
+    try:
+        for token in lexer:
+            if set(token) == {"|"}:
+                groups.extend([] for _ in token)
+            else:
+                groups[-1].append(token)
+    except ValueError as e:
+        raise ParseError(str(e))
+    steps = []
+    for i, tokens in enumerate(groups):
+        try:
+            steps.append(parse_step(tokens))
+        except ParseError as e:
+            raise ParseError(f"Error parsing step {i + 1}: {e}")
+    if len(steps) > MAX_CHAIN_STEPS:
+        raise ParseError(f"Chains can have at most {MAX_CHAIN_STEPS} steps")
+    if any(step.op == "gif" for step in steps[:-1]):
+        raise ParseError("gif has to be the last step")
+    return tuple(steps)
+
+
 class File:
-    def __init__(self, name: str, type: str) -> None:
+    def __init__(
+        self,
+        name: str,
+        type: str,
+        digest: Optional[str] = None,
+        probe: Optional[ffutil.Probe] = None,
+    ) -> None:
         self.name = name
         self.type = type
+        self.digest = digest
+        self.probe = probe
 
 
-def maybe_audio(probe, input):
-    audio = (s for s in probe["streams"] if s["codec_type"] == "audio")
-    stream = next(audio, None)
-    if not stream:
-        return None
-    return input.audio
+class OutputTooLargeError(commands.BadArgument):
+    def __init__(self, limit: int) -> None:
+        super().__init__(f"Output is larger than {limit // (1 << 20)} MiB")
+
+
+@dataclass
+class Output:
+    suffix: str
+    path: Optional[str] = None
+    data: Optional[bytes] = None
+    # How the result was made: "copy" when every stream was stream-copied,
+    # "copy_video" when only audio was re-encoded, "encode", or "cached".
+    plan: str = "encode"
+
+    @property
+    def filename(self) -> str:
+        return "output" + self.suffix
+
+    @property
+    def size(self) -> int:
+        if self.data is not None:
+            return len(self.data)
+        return os.path.getsize(self.path)
 
 
-def write_overlay(func: Callable, width: int, height: int, *args, **kwargs) -> str:
+def save_image(image: pyvips.Image, suffix: str, in_memory: bool) -> Output:
+    if in_memory:
+        return Output(suffix, data=vips.watch(image).write_to_buffer(suffix))
+    return Output(suffix, path=vips.write_image(image, suffix))
+
+
+# ffmpeg can't seek back on a pipe, so MP4 output has to be fragmented.
+PIPE_FORMATS = {
+    ".mp4": {"f": "mp4", "movflags": "frag_keyframe+empty_moov+default_base_moof"},
+    ".gif": {"f": "gif"},
+    ".png": {"f": "image2pipe", "vcodec": "png"},
+}
+
+
+def render_overlay(func: Callable, width: int, height: int, *args, **kwargs) -> bytes:
     image: pyvips.Image = func(width, height, *args, **kwargs)
-    return vips.write_image(image, ".png")
+    # write_to_memory() gives a cffi buffer, which can't be pickled back from
+    # a pool worker or written to ffmpeg's stdin.
+    return bytes(vips.watch(vips.to_rgba(image)).write_to_memory())
 
 
-def vips_overlay(input: File, func: Callable, *args, **kwargs) -> str:
-    if input.type == "gif":
-        input_image: pyvips.Image = pyvips.Image.new_from_file(
-            input.name, n=-1, access="sequential"
-        )
-    else:
-        input_image: pyvips.Image = pyvips.Image.new_from_file(input.name)
+def load_image(input: File) -> pyvips.Image:
+    if input.type != "gif":
+        return pyvips.Image.new_from_file(input.name)
+    try:
+        return vips.load_gif(input.name)
+    except vips.LimitError as e:
+        raise commands.BadArgument(str(e))
+
+
+def vips_overlay(
+    input: File, in_memory: bool, suffix: str, func: Callable, *args, **kwargs
+) -> Output:
+    input_image = load_image(input)
     overlay: pyvips.Image = func(
         input_image.width, input_image.get_page_height(), *args, **kwargs
     )
     replicated: pyvips.Image = overlay.replicate(1, input_image.get_n_pages())
     output: pyvips.Image = input_image.composite2(replicated, "over")
-    suffix = ".gif" if input.type == "gif" else ".png"
-    out = vips.write_image(output, suffix)
-    return out
+    return save_image(output, suffix, in_memory)
+
 
+def read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
 
-def dimensions_from_probe(probe):
-    video = next((s for s in probe["streams"] if s["codec_type"] == "video"), None)
-    if not video:
+
+def dimensions_from_probe(probe: ffutil.Probe) -> Tuple[int, int]:
+    if probe.video is None:
         raise commands.BadArgument("No video stream found")
-    return video["width"], video["height"]
+    return probe.video.width, probe.video.height
 
-def caption(input: File, text: str):
-    if input.type == "gif":
-        input_image: pyvips.Image = pyvips.Image.new_from_file(
-            input.name, n=-1, access="sequential"
-        )
-    else:
-        input_image: pyvips.Image = pyvips.Image.new_from_file(input.name)
+
+def scaled_dimensions(width: int, height: int, scale: float) -> Tuple[int, int]:
+    if scale >= 1:
+        return width, height
+    return encoding.even(width * scale), encoding.even(height * scale)
+
+
+def palette_gif(
+    video, width: int, height: int, tier: encoding.Tier, scale: float = 1.0
+):
+    """Caps a video's frame rate and size for the tier and maps it to a
+    palette generated from the video itself."""
+    video = video.filter("fps", tier.fps)
+    bounded = encoding.bound(
+        *scaled_dimensions(width, height, scale), tier.max_dimension
+    )
+    if bounded != (width, height):
+        video = video.filter("scale", *bounded)
+    split = video.filter_multi_output("split")
+    palette = split[0].filter("palettegen", max_colors=tier.palette_colors)
+    return ffmpeg.filter([split[1], palette], "paletteuse", dither=tier.dither)
+
+
+def caption(input: File, in_memory: bool, suffix: str, text: str) -> Output:
+    input_image = load_image(input)
     caption = vips.caption(input_image.width, text)
     out = vips.vstack(caption, input_image)
-    suffix = ".gif" if input.type == "gif" else ".png"
-    return vips.write_image(out, suffix)
+    return save_image(out, suffix, in_memory)
+
+
+def crop_box(
+    width: int, height: int, direction: str, amount: int
+) -> Tuple[int, int, int, int]:
+    if direction == "top":
+        return (width, height - amount, 0, amount)
+    elif direction == "bottom":
+        return (width, height - amount, 0, 0)
+    elif direction == "left":
+        return (width - amount, height, amount, 0)
+    elif direction == "right":
+        return (width - amount, height, 0, 0)
+    raise commands.BadArgument("Invalid crop direction")
+
+
+# Steps a chain on an image or GIF can run entirely in vips.
+VIPS_STEPS = {"meme", "caption", "crop"}
+
+
+def vips_chain(
+    input: File, in_memory: bool, suffix: str, steps: Tuple[Step, ...]
+) -> Output:
+    image = load_image(input)
+    for step in steps:
+        page_height = image.get_page_height()
+        if step.op == "meme":
+            overlay = vips.meme(image.width, page_height, *step.args)
+            replicated = overlay.replicate(1, image.get_n_pages())
+            image = image.composite2(replicated, "over")
+        elif step.op == "caption":
+            image = vips.vstack(vips.caption(image.width, *step.args), image)
+        elif step.op == "crop":
+            w, h, x, y = crop_box(image.width, page_height, *step.args)
+            image = vips.crop(image, x, y, w, h)
+    return save_image(image, suffix, in_memory)
+
+
+# Steps a chain renders an RGBA layer for.
+LAYER_STEPS = {"meme", "caption"}
+
+
+def render_layers(
+    width: int, height: int, steps: Tuple[Step, ...]
+) -> Tuple[bytes, int, int, list]:
+    """Renders a chain's meme and caption layers into one RGBA sheet.
+
+    ffmpeg has a single stdin, so the layers are stacked top to bottom and
+    fed on it as one raw frame. Returns the sheet, its size and each layer's
+    width, height and offset in it.
+    """
+    images = []
+    for step in steps:
+        if step.op == "crop":
+            width, height, _, _ = crop_box(width, height, *step.args)
+        elif step.op == "meme":
+            images.append(vips.to_rgba(vips.meme(width, height, *step.args)))
+        elif step.op == "caption":
+            image = vips.to_rgba(vips.caption(width, *step.args))
+            images.append(image)
+            height += image.height
+    boxes = []
+    top = 0
+    for image in images:
+        boxes.append((image.width, image.height, top))
+        top += image.height
+    sheet = pyvips.Image.black(max(w for w, _, _ in boxes), top, bands=4)
+    for image, (_, _, y) in zip(images, boxes):
+        sheet = sheet.insert(image, 0, y)
+    data = bytes(vips.watch(sheet).write_to_memory())
+    return data, sheet.width, sheet.height, boxes
+
+
+def trimmed_duration(edits: Edits, duration: Optional[float]) -> Optional[float]:
+    """The duration left between edits' start and end."""
+    end = edits.end or duration
+    if end is not None and edits.start > end:
+        raise commands.BadArgument("Start time must be before end time")
+    return None if end is None else end - edits.start
+
+
+def input_seek(edits: Edits, duration: Optional[float]) -> dict:
+    """Input options that trim to edits, given the trimmed duration.
+
+    Seeking the input instead of using the trim filter means nothing before
+    the start is decoded.
+    """
+    return {"ss": edits.start or None, "t": duration if edits.end else None}
+
+
+def apply_edits(
+    video,
+    audio,
+    duration: Optional[float],
+    edits: Edits,
+    seeked: bool = False,
+    mix: Optional[Callable] = None,
+):
+    """Applies edits to already filtered streams, returning them and the new
+    duration.
+
+    If seeked, the input was already trimmed with input_seek and duration is
+    the trimmed one. mix is applied to the audio, or None if there's none,
+    before speed and reverse.
+    """
+    if not seeked and (edits.start or edits.end):
+        duration = trimmed_duration(edits, duration)
+        trim = {"start": edits.start}
+        if duration is not None:
+            trim["end"] = edits.start + duration
+        video = video.filter("trim", **trim).filter("setpts", "PTS-STARTPTS")
+        if audio:
+            audio = audio.filter("atrim", **trim).filter("asetpts", "PTS-STARTPTS")
+    if edits.mute:
+        audio = None
+    if audio and edits.volume:
+        audio = audio.filter("volume", edits.volume)
+    if mix is not None:
+        audio = mix(audio)
+    if edits.speed:
+        video = video.filter("setpts", f"{1 / edits.speed}*PTS")
+        if audio:
+            audio = audio.filter("atempo", edits.speed)
+        if duration is not None:
+            duration /= edits.speed
+    if edits.vreverse:
+        video = video.filter("reverse")
+    if audio and edits.areverse:
+        audio = audio.filter("areverse")
+    return video, audio, duration
+
+
+def mix_music(
+    graph: Graph,
+    music: Tuple[str, float],
+    edits: Edits,
+    duration: Optional[float],
+    audio,
+):
+    source, offset = music
+    track = graph.input(source, ss=offset or None).filter("volume", edits.musicvolume)
+    if not audio:
+        audio = graph.silence(duration)
+    if not edits.musicdelay:
+        return ffmpeg.filter(
+            [audio, track], "amix", duration="first", dropout_transition=0
+        )
+    split = audio.filter_multi_output("asplit", 2)
+    part1 = (
+        split[0].filter("atrim", end=edits.musicdelay).filter("asetpts", "PTS-STARTPTS")
+    )
+    part2 = (
+        split[1]
+        .filter("atrim", start=edits.musicdelay)
+        .filter("asetpts", "PTS-STARTPTS")
+    )
+    part2merged = ffmpeg.filter(
+        [part2, track], "amix", duration="first", dropout_transition=0
+    )
+    return ffmpeg.filter([part1, part2merged], "concat", n=2, v=0, a=1)
+
+
+def edit_streams(
+    name: str,
+    probe: ffutil.Probe,
+    edits: Edits,
+    duration: Optional[float],
+    music: Optional[Tuple[str, float]],
+    copy_video: bool,
+    scale: float = 1.0,
+) -> Tuple[list, dict, str]:
+    """Builds the streams for edits, and the codec arguments and plan.
+
+    duration is the trimmed one, the input is seeked to the trim.
+    """
+    graph = Graph()
+    seek = input_seek(edits, duration)
+    video = graph.video(name, probe, **seek)
+    if scale < 1 and not copy_video:
+        video = video.filter(
+            "scale", *scaled_dimensions(probe.video.width, probe.video.height, scale)
+        )
+    audio = graph.audio(name, probe, **seek)
+    mix = None
+    if music is not None:
+        mix = functools.partial(mix_music, graph, music, edits, duration)
+    video, audio, _ = apply_edits(video, audio, duration, edits, seeked=True, mix=mix)
+    changed = bool(edits.speed or edits.areverse or edits.volume or music)
+    streams = [video]
+    if audio:
+        streams.append(audio)
+    kwargs = {}
+    if not copy_video:
+        return streams, kwargs, "encode"
+    kwargs["vcodec"] = "copy"
+    if audio and (changed or not streamcopy.copyable_audio(probe)):
+        return streams, kwargs, "copy_video"
+    if audio:
+        kwargs["acodec"] = "copy"
+    return streams, kwargs, "copy"
+
+
+# Bump when an operation's output changes so stale cached results are ignored.
+RESULT_VERSION = 3
+
+# Formats animated results can be asked for in.
+ANIMATED_FORMATS = {"gif": ".gif", "webp": ".webp", "mp4": ".mp4"}
+
+
+def normalize_arg(arg: Any) -> Any:
+    if isinstance(arg, (list, tuple)):
+        return [normalize_arg(a) for a in arg]
+    if isinstance(arg, File):
+        return {"file": arg.digest}
+    if dataclasses.is_dataclass(arg):
+        return dataclasses.asdict(arg)
+    if isinstance(arg, float) and arg.is_integer():
+        return int(arg)
+    return arg
+
+
+def result_key(op: str, args: tuple, tier: encoding.Tier) -> Optional[str]:
+    if any(isinstance(arg, File) and arg.digest is None for arg in args):
+        return None
+    return json.dumps(
+        [RESULT_VERSION, op, tier.name, [normalize_arg(arg) for arg in args]],
+        sort_keys=True,
+    )
+
+
+@dataclass
+class Rendering:
+    # Pinned for the whole operation, since it's part of the result key.
+    tier: encoding.Tier
+    # Set by admission; downscaled results aren't cached.
+    scale: float = 1.0
+
+
+rendering: contextvars.ContextVar[Optional[Rendering]] = contextvars.ContextVar(
+    "rendering", default=None
+)
+
+
+@dataclass(eq=False)
+class Flight:
+    # Resolves to the stored cache entry, or to one copy of the output per
+    # waiter when the output isn't cached.
+    future: asyncio.Future
+    waiters: int = 0
+
+
+def copy_output(out: Output) -> Output:
+    if out.data is not None:
+        return dataclasses.replace(out)
+    path = tmpfile.unused(out.suffix)
+    cache.link(out.path, path)
+    return dataclasses.replace(out, path=path)
+
+
+def discard_output(out: Output) -> None:
+    if out.path is not None:
+        os.remove(out.path)
+
+
+def cached_result(func: Callable) -> Callable:
+    @functools.wraps(func)
+    async def wrapper(self: "Processing", *args) -> Output:
+        async def render() -> Output:
+            try:
+                out = await func(self, *args)
+            except MissingStreamError as e:
+                raise commands.BadArgument(str(e))
+            self.check_size(out)
+            return out
+
+        tier = encoding.TIERS[ffutil.scheduler.quality_level()]
+        token = rendering.set(Rendering(tier))
+        try:
+            key = result_key(func.__name__, args, tier)
+            if self.results is None or key is None:
+                return await render()
+            return await self.single_flight(key, render)
+        finally:
+            rendering.reset(token)
+
+    return wrapper
+
 
 class Processing:
-    def __init__(self, exec: futures.Executor, loop: asyncio.AbstractEventLoop) -> None:
+    def __init__(
+        self,
+        exec: futures.Executor,
+        loop: asyncio.AbstractEventLoop,
+        results: Optional[cache.DiskCache] = None,
+        in_memory: bool = True,
+        max_output: int = 10 << 20,
+        music: Optional[musicutil.Music] = None,
+        budget: Optional[cost.Budget] = None,
+        model: Optional[cost.Model] = None,
+    ) -> None:
         self.exec = exec
         self.loop = loop
+        self.results = results
+        self.in_memory = in_memory
+        self.max_output = max_output
+        self.music = music or musicutil.Music()
+        self.budget = budget
+        self.model = model or cost.Model()
+        self.inflight: dict[str, Flight] = {}
+
+    def check_size(self, out: Output) -> None:
+        if out.size >= self.max_output:
+            if out.path is not None:
+                os.remove(out.path)
+            raise OutputTooLargeError(self.max_output)
+
+    async def checkout_result(self, entry: cache.Entry) -> Optional[Output]:
+        suffix = entry.meta["suffix"]
+        if self.in_memory:
+            try:
+                data = await asyncio.to_thread(read_file, entry.path)
+            except FileNotFoundError:
+                return None
+            return Output(suffix, data=data, plan="cached")
+        out = tmpfile.unused(suffix)
+        if self.results.checkout(entry, out):
+            return Output(suffix, path=out, plan="cached")
+        return None
+
+    async def store_result(self, key: str, out: Output) -> cache.Entry:
+        meta = {"suffix": out.suffix}
+        if out.data is not None:
+            return await asyncio.to_thread(self.results.put_bytes, out.data, key, meta)
+        return await asyncio.to_thread(self.results.put_file, out.path, key, meta)
+
+    async def single_flight(self, key: str, render: Callable) -> Output:
+        if entry := self.results.lookup(key):
+            if out := await self.checkout_result(entry):
+                return out
+        while flight := self.inflight.get(key):
+            fut = flight.future
+            flight.waiters += 1
+            try:
+                result = await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                if not fut.done():
+                    flight.waiters -= 1
+                elif (
+                    not fut.cancelled()
+                    and fut.exception() is None
+                    and isinstance(fut.result(), list)
+                ):
+                    # Our copy was already made.
+                    discard_output(fut.result().pop())
+                # The job we were waiting on was cancelled, not us: take over.
+                if fut.cancelled() and not asyncio.current_task().cancelling():
+                    continue
+                raise
+            if isinstance(result, list):
+                return result.pop()
+            if out := await self.checkout_result(result):
+                return out
+            return await render()
+        flight = Flight(self.loop.create_future())
+        self.inflight[key] = flight
+        try:
+            out = await render()
+            if rendering.get().scale == 1.0:
+                result = await self.store_result(key, out)
+            else:
+                # Downscaled outputs stay out of the cache, so everyone
+                # waiting gets a copy of this one instead of rendering again.
+                result = [copy_output(out) for _ in range(flight.waiters)]
+        except asyncio.CancelledError:
+            flight.future.cancel()
+            raise
+        except BaseException as e:
+            flight.future.set_exception(e)
+            flight.future.exception()
+            raise
+        else:
+            flight.future.set_result(result)
+            return out
+        finally:
+            del self.inflight[key]
+
+    def blocking(self, func: Callable, *args, **kwargs) -> Callable:
+        """func bound to the current job's deadline, to be run in self.exec.
+
+        A cancelled job stops waiting for its result right away, but the
+        worker only lets go of it once the deadline passes.
+        """
+        until = None
+        if (left := time_left()) is not None:
+            until = time.time() + left
+        return functools.partial(vips.run_until, until, func, *args, **kwargs)
+
+    async def run_blocking(self, job: Callable) -> Any:
+        """Runs a job made by blocking() and counts the text cache hits and
+        misses it had in the worker."""
+        result, counts = await self.loop.run_in_executor(self.exec, job)
+        for cache, (hits, misses) in counts.items():
+            trace.count("text_cache_hits", hits, cache=cache)
+            trace.count("text_cache_misses", misses, cache=cache)
+        return result
 
     async def spawn_blocking(self, func: Callable, *args, **kwargs) -> Any:
-        return await self.loop.run_in_executor(
-            self.exec, functools.partial(func, *args, **kwargs)
+        async with ffutil.scheduler.slot(Priority.IMAGE):
+            with trace.span("render", func=func.__name__):
+                return await self.run_blocking(self.blocking(func, *args, **kwargs))
+
+    async def encode_once(
+        self,
+        streams: list,
+        suffix: str,
+        priority: Priority,
+        stdin: Optional[Awaitable[bytes]],
+        limit: int,
+        **kwargs,
+    ) -> Output:
+        if self.in_memory:
+            kwargs.update(PIPE_FORMATS[suffix])
+            # Stop as soon as the output is known to be too large.
+            kwargs["fs"] = limit
+            spec = ffmpeg.output(*streams, "pipe:1", **kwargs)
+            data = await ffutil.run(
+                spec.global_args("-loglevel", "error"), priority, stdin
+            )
+            return Output(suffix, data=data)
+        out = tmpfile.reserve(suffix)
+        try:
+            spec = ffmpeg.output(*streams, out, **kwargs)
+            await ffutil.run(spec.global_args("-loglevel", "error"), priority, stdin)
+            return Output(suffix, path=out)
+        except BaseException as e:
+            os.remove(out)
+            raise e
+
+    async def try_copy(self, streams: list, plan: str, **kwargs) -> Optional[Output]:
+        """Stream copies into an MP4, or returns None if that came out too
+        large, since a copy can't be shrunk to fit."""
+        # Copying costs about as much as an image job, so it queues like one.
+        out = await self.encode_once(
+            streams, ".mp4", Priority.IMAGE, None, self.max_output, **kwargs
         )
+        if out.size < self.max_output:
+            out.plan = plan
+            return out
+        if out.path is not None:
+            os.remove(out.path)
+        return None
 
-    async def dimensions(self, filepath: str, media_type: str) -> Tuple[int, int]:
-        if media_type in ["gif", "image"]:
-            return await self.spawn_blocking(self.exec, vips.dimensions, filepath)
-        else:
-            probed = await ffutil.probe(filepath)
-            return probed.video.width, probed.video.height
-
-    async def ffmpeg_overlay(self, input: File, func: Callable, *args, **kwargs) -> str:
-        overlay_file = None
-        info = await ffutil.probe(input.name)
-        video = next(
-            (stream for stream in info["streams"] if stream["codec_type"] == "video"),
-            None,
+    async def encode(
+        self,
+        streams: list,
+        suffix: str,
+        priority: Priority = Priority.VIDEO,
+        stdin: Optional[Awaitable[bytes]] = None,
+        fit: Optional[encoding.Source] = None,
+        tier: Optional[encoding.Tier] = None,
+        **kwargs,
+    ) -> Output:
+        tier = tier or self.tier()
+        if suffix == ".mp4" and kwargs.get("vcodec") != "copy":
+            kwargs.setdefault("preset", tier.preset)
+        if fit is None:
+            return await self.encode_once(
+                streams, suffix, priority, stdin, self.max_output, **kwargs
+            )
+        fit = dataclasses.replace(
+            fit, fps=min(fit.fps, tier.fps), max_dimension=tier.max_dimension
         )
-        width = video["width"]
-        height = video["height"]
-        overlay_file = await self.spawn_blocking(
-            write_overlay, func, width, height, *args, **kwargs
+        try:
+            target = encoding.plan(self.max_output, fit)
+        except encoding.BudgetError as e:
+            raise commands.BadArgument(str(e))
+        for _ in range(encoding.MAX_PASSES):
+            video = streams[0]
+            if (target.width, target.height) != (fit.width, fit.height):
+                video = video.filter("scale", target.width, target.height)
+            # Let an oversized pass run a bit past the limit so the next pass
+            # can be sized from how far off it was.
+            out = await self.encode_once(
+                [video, *streams[1:]],
+                suffix,
+                priority,
+                stdin,
+                self.max_output * 2,
+                **{**kwargs, **target.output_args()},
+            )
+            if out.size < self.max_output:
+                return out
+            produced = out.size
+            if out.path is not None:
+                os.remove(out.path)
+            try:
+                target = encoding.shrink(self.max_output, fit, target, produced)
+            except encoding.BudgetError:
+                break
+        raise OutputTooLargeError(self.max_output)
+
+    def admit(self, op: str, *works: Optional[cost.Work]) -> cost.Admission:
+        """Estimates a job from its probes before anything is decoded, and
+        rejects, downscales or defers it if it's over budget."""
+        if not works or any(w is None for w in works):
+            return cost.Admission()
+        estimate = self.model.estimate(op, *works)
+        trace.annotate(
+            cost_op=op,
+            cost_work=sum(w.megapixel_frames for w in works),
+            cost_cpu=round(estimate.cpu, 2),
+            cost_memory=estimate.memory,
         )
-        in_file = ffmpeg.input(input.name)
-        overlay = ffmpeg.input(overlay_file)
-        out = ffmpeg.overlay(in_file, overlay)
-        suffix = ".gif" if input.type != "video" else ".mp4"
-        tf = tmpfile.reserve(suffix)
-        streams = [out]
-        kwargs = {}
-        if stream := maybe_audio(info, in_file):
-            streams.append(stream)
-            kwargs["acodec"] = "copy"
+        if self.budget is None:
+            return cost.Admission()
+        try:
+            admission = self.model.admit(op, estimate, self.budget)
+        except cost.AdmissionError as e:
+            raise commands.BadArgument(str(e))
+        trace.annotate(admission=admission.action, admission_scale=admission.scale)
+        if (state := rendering.get()) is not None:
+            state.scale = admission.scale
+        return admission
+
+    def tier(self) -> encoding.Tier:
+        if (state := rendering.get()) is not None:
+            return state.tier
+        return encoding.TIERS[ffutil.scheduler.quality_level()]
+
+    def fit(
+        self,
+        probe: ffutil.Probe,
+        duration: Optional[float] = None,
+        width: Optional[int] = None,
+        height: Optional[int] = None,
+        has_audio: Optional[bool] = None,
+    ) -> Optional[encoding.Source]:
+        if duration is None:
+            duration = probe.duration
+        if duration is None or probe.video is None:
+            return None
+        fps = encoding.parse_rate(probe.video.frame_rate) or 30
+        return encoding.Source(
+            duration,
+            width or probe.video.width,
+            height or probe.video.height,
+            min(fps, 30),
+            probe.audio is not None if has_audio is None else has_audio,
+        )
+
+    async def probe(self, input: File) -> ffutil.Probe:
+        if input.probe is None:
+            input.probe = await ffutil.probe(input.name, input.digest)
+        return input.probe
+
+    async def dimensions(self, input: File) -> Tuple[int, int]:
+        return dimensions_from_probe(await self.probe(input))
+
+    async def ffmpeg_overlay(
+        self, input: File, suffix: str, func: Callable, *args, **kwargs
+    ) -> Output:
+        info = await self.probe(input)
+        width, height = dimensions_from_probe(info)
+        # Render while ffmpeg waits for its slot and starts up; the frame is
+        # fed to its stdin once ready. This bypasses the scheduler on purpose,
+        # the ffmpeg job already holds the slot the overlay belongs to.
+        job = self.blocking(render_overlay, func, width, height, *args, **kwargs)
+
+        async def render() -> bytes:
+            with trace.span("render", func=func.__name__):
+                return await self.run_blocking(job)
+
+        graph = Graph()
+        video = graph.video(input.name, info)
+        overlay = graph.input(
+            "pipe:0", f="rawvideo", pix_fmt="rgba", s=f"{width}x{height}"
+        )
+        rendered = asyncio.ensure_future(render())
+        out = ffmpeg.overlay(video, overlay)
+        tier = self.tier()
+        fit = None
+        output_args = {}
+        if suffix == ".gif":
+            streams = [palette_gif(out, width, height, tier)]
+        else:
+            if input.type != "video":
+                out = out.filter("fps", tier.fps)
+            out = out.filter("pad", "ceil(iw/2)*2", "ceil(ih/2)*2")
+            fit = self.fit(info, width=width + width % 2, height=height + height % 2)
+            streams = [out]
+            # Only MP4 takes the audio, the GIF muxer has room for one video
+            # stream and nothing else.
+            if stream := graph.audio(input.name, info):
+                streams.append(stream)
+                output_args["acodec"] = "copy"
         try:
-            await ffutil.run(
-                ffmpeg.output(*streams, tf, **kwargs).global_args("-loglevel", "error")
+            return await self.encode(
+                streams, suffix, stdin=rendered, fit=fit, tier=tier, **output_args
             )
-            return tf
-        except Exception as e:
-            os.remove(tf)
-            raise e
         finally:
-            if overlay_file is not None:
-                os.remove(overlay_file)
+            rendered.cancel()
+
+    async def output_suffix(self, input: File, format: Optional[str] = None) -> str:
+        """The suffix to write an edited input in.
+
+        Stills stay PNG and videos MP4 unless a GIF is asked for. Animations
+        are only written as GIF when asked for, since a WebP or MP4 of one is
+        many times smaller and faster to encode; which of those is picked by
+        encoding.animated_format.
+        """
+        if input.type == "image":
+            return ".png"
+        if format is not None:
+            suffix = ANIMATED_FORMATS[format]
+        elif input.type == "video":
+            suffix = ".mp4"
+        elif work := cost.work(await self.probe(input)):
+            suffix = encoding.animated_format(
+                self.max_output, work.width, work.height, work.frames
+            )
+        else:
+            suffix = ".webp"
+        if input.type == "video" and suffix == ".webp":
+            raise commands.BadArgument("WebP output is only available for GIFs")
+        trace.annotate(output_format=suffix[1:])
+        return suffix
 
-    async def overlay(self, input: File, func: Callable, *args, **kwargs) -> str:
-        if input.type in ["gif", "image"]:
-            return await self.spawn_blocking(vips_overlay, input, func, *args, **kwargs)
+    async def overlay(
+        self, input: File, format: Optional[str], func: Callable, *args, **kwargs
+    ) -> Output:
+        suffix = await self.output_suffix(input, format)
+        if input.type in ["gif", "image"] and suffix != ".mp4":
+            return await self.spawn_blocking(
+                vips_overlay, input, self.in_memory, suffix, func, *args, **kwargs
+            )
         else:
-            return await self.ffmpeg_overlay(input, func, *args, **kwargs)
+            return await self.ffmpeg_overlay(input, suffix, func, *args, **kwargs)
+
+    async def copy_concat(
+        self, entries: list[tuple[str, Optional[float]]], **kwargs
+    ) -> Optional[Output]:
+        script = tmpfile.reserve(".ffconcat")
+        try:
+            with open(script, "w") as f:
+                f.write(streamcopy.concat_list(entries))
+            input = ffmpeg.input(script, f="concat", safe=0)
+            return await self.try_copy([input], "copy", c="copy", **kwargs)
+        finally:
+            os.remove(script)
 
-    async def cut(self, file1, file2, delay: int) -> str:
-        i1 = ffmpeg.input(file1.name)
-        i2 = ffmpeg.input(file2.name)
-        v1, v2 = i1.video, i2.video
-        a1, a2 = i1.audio, i2.audio
+    @cached_result
+    async def cut(self, file1, file2, delay: int) -> Output:
+        probe1 = await self.probe(file1)
+        probe2 = await self.probe(file2)
+        first = delay if delay > 0 else probe1.duration
+        if (
+            file1.type == file2.type == "video"
+            and first is not None
+            and probe2.duration is not None
+            and streamcopy.concatable(probe1, probe2)
+            and streamcopy.fits(
+                self.max_output, (probe1, first), (probe2, probe2.duration)
+            )
+        ):
+            outpoint = delay if delay > 0 else None
+            out = await self.copy_concat([(file1.name, outpoint), (file2.name, None)])
+            if out is not None:
+                return out
+        graph = Graph()
+        v1 = graph.video(file1.name, probe1)
+        v2 = graph.video(file2.name, probe2)
+        # concat needs audio from both parts or neither, so a silent part gets
+        # silence of its length, if that's known.
+        a1 = graph.audio(file1.name, probe1)
+        a2 = graph.audio(file2.name, probe2)
+        if a1 is None and a2 is not None and first is not None:
+            a1 = graph.silence(first)
+        if a2 is None and a1 is not None and probe2.duration is not None:
+            a2 = graph.silence(probe2.duration)
+        tier = self.tier()
         if delay > 0:
             v1 = v1.filter("trim", end=delay)
-            a1 = a1.filter("atrim", end=delay)
-        width, height = dimensions_from_probe(await ffutil.probe(file1.name))
+            if a1 is not None:
+                a1 = a1.filter("atrim", end=delay)
+        width, height = dimensions_from_probe(probe1)
         v2 = v2.filter(
             "scale", width, height, force_original_aspect_ratio="decrease"
         ).filter("pad", width, height, -1, -1)
-        joined = ffmpeg.filter_multi_output([v1, a1, v2, a2], "concat", v=1, a=1)
-        out = tmpfile.reserve(".mp4")
-        try:
-            await ffutil.run(ffmpeg.output(joined[0].filter("fps", 30), joined[1], out))
-            return out
-        except Exception as e:
-            os.remove(out)
-            raise e
+        if a1 is not None and a2 is not None:
+            joined = ffmpeg.filter_multi_output([v1, a1, v2, a2], "concat", v=1, a=1)
+            streams = [joined[0].filter("fps", tier.fps), joined[1]]
+        else:
+            joined = ffmpeg.filter_multi_output([v1, v2], "concat", v=1, a=0)
+            streams = [joined[0].filter("fps", tier.fps)]
+        fit = None
+        if first is not None and probe2.duration is not None:
+            fit = self.fit(
+                probe1,
+                duration=first + probe2.duration,
+                has_audio=len(streams) > 1,
+            )
+        return await self.encode(streams, ".mp4", fit=fit, tier=tier)
 
-    async def gif(self, inputf: File) -> str:
-        out = tmpfile.reserve(".gif")
-        input = ffmpeg.input(inputf.name)
-        input = input.filter("fps", 30)
-        split = input.filter_multi_output("split")
-        palette = split[0].filter("palettegen")
-        output = ffmpeg.filter([split[1], palette], "paletteuse")
-        try:
-            await ffutil.run(output.output(out))
-            return out
-        except Exception as e:
-            os.remove(out)
-            raise e
+    @cached_result
+    async def gif(self, inputf: File) -> Output:
+        tier = self.tier()
+        probe = await self.probe(inputf)
+        admission = self.admit("gif", cost.work(probe))
+        width, height = dimensions_from_probe(probe)
+        output = palette_gif(
+            Graph().video(inputf.name, probe), width, height, tier, admission.scale
+        )
+        return await self.encode(
+            [output], ".gif", admission.priority or Priority.VIDEO, tier=tier
+        )
 
-    async def loopvid(self, inputf: File, length: int) -> str:
-        out = tmpfile.reserve(".mp4")
-        input = ffmpeg.input(inputf.name, stream_loop=-1)
+    @cached_result
+    async def loopvid(self, inputf: File, length: int) -> Output:
+        tier = self.tier()
+        probe = await self.probe(inputf)
+        if (
+            inputf.type == "video"
+            and probe.duration
+            and streamcopy.copyable(probe)
+            and streamcopy.fits(self.max_output, (probe, length))
+        ):
+            # Repeating the file with the concat demuxer only copies packets.
+            loops = math.ceil(length / probe.duration)
+            out = await self.copy_concat([(inputf.name, None)] * loops, t=length)
+            if out is not None:
+                return out
+        admission = self.admit("loopvid", cost.work(probe, length))
+        graph = Graph()
+        video = graph.video(inputf.name, probe, stream_loop=-1)
         if inputf.type in ["gif", "image"]:
-            input = input.filter("fps", 30)
-        output = input.output(out, t=length)
-        try:
-            await ffutil.run(output)
-            return out
-        except Exception as e:
-            os.remove(out)
-            raise e
+            video = video.filter("fps", tier.fps)
+        width, height = dimensions_from_probe(probe)
+        if admission.scale < 1:
+            width, height = scaled_dimensions(width, height, admission.scale)
+            video = video.filter("scale", width, height)
+        streams = [video]
+        if audio := graph.audio(inputf.name, probe, stream_loop=-1):
+            streams.append(audio)
+        fit = self.fit(probe, duration=length, width=width, height=height)
+        return await self.encode(
+            streams,
+            ".mp4",
+            admission.priority or Priority.VIDEO,
+            fit=fit,
+            tier=tier,
+            t=length,
+        )
 
-    async def first_frame(self, inputf: File) -> str:
-        out = tmpfile.reserve(".png")
-        input = ffmpeg.input(inputf.name)
-        output = input.output(out, vframes=1)
-        try:
-            await ffutil.run(output)
-            return out
-        except Exception as e:
-            os.remove(out)
-            raise e
+    @cached_result
+    async def first_frame(self, inputf: File) -> Output:
+        video = Graph().video(inputf.name)
+        return await self.encode([video], ".png", Priority.IMAGE, vframes=1)
 
-    async def crop(self, input: File, direction: str, amount: int) -> str:
-        probe = await ffutil.probe(input.name)
+    @cached_result
+    async def crop(self, input: File, direction: str, amount: int) -> Output:
+        probe = await self.probe(input)
         width, height = dimensions_from_probe(probe)
-        if direction == "top":
-            crop = (width, height - amount, 0, amount)
-        elif direction == "bottom":
-            crop = (width, height - amount, 0, 0)
-        elif direction == "left":
-            crop = (width - amount, height, amount, 0)
-        elif direction == "right":
-            crop = (width - amount, height, 0, 0)
-        else:
-            raise commands.BadArgument("Invalid crop direction")
-        input = ffmpeg.input(input.name)
-        cropped = input.video.filter("crop", *crop)
-        out = tmpfile.reserve(".mp4")
+        crop = crop_box(width, height, direction, amount)
+        graph = Graph()
+        cropped = graph.video(input.name, probe).filter("crop", *crop)
         streams = [cropped]
-        if stream := maybe_audio(probe, input):
+        if stream := graph.audio(input.name, probe):
             streams.append(stream)
-        try:
-            await ffutil.run(ffmpeg.output(*streams, out))
-            return out
-        except Exception as e:
-            os.remove(out)
-            raise e
+        fit = self.fit(probe, width=crop[0], height=crop[1])
+        return await self.encode(streams, ".mp4", fit=fit)
 
-    async def stack(self, orientation, file1, file2) -> str:
+    @cached_result
+    async def stack(self, orientation, file1, file2) -> Output:
         if orientation not in ["vstack", "hstack"]:
             raise commands.BadArgument("Invalid stack orientation")
-        probe1 = await ffutil.probe(file1.name)
-        probe2 = await ffutil.probe(file2.name)
+        probe1 = await self.probe(file1)
+        probe2 = await self.probe(file2)
+        tier = self.tier()
+        # The shorter input is padded out to the longer one.
+        duration = None
+        if probe1.duration is not None and probe2.duration is not None:
+            duration = max(probe1.duration, probe2.duration)
+        admission = self.admit(
+            "stack", cost.work(probe1, duration), cost.work(probe2, duration)
+        )
 
-        def input(f):
+        graph = Graph()
+
+        def input(f, probe):
             return (
-                ffmpeg.input(f.name)
-                .video.filter("setpts", "PTS-STARTPTS")
+                graph.video(f.name, probe)
+                .filter("setpts", "PTS-STARTPTS")
                 .filter("format", "yuv420p")
             )
 
-        input1 = input(file1)
-        input2 = input(file2)
+        input1 = input(file1, probe1)
+        input2 = input(file2, probe2)
         if orientation == "vstack":
             scaled = ffmpeg.filter_multi_output(
                 [input1, input2], "scale2ref", "iw", "ow/mdar"
@@ -339,123 +1135,244 @@ class Processing:
         stacked = (
             ffmpeg.filter([scaled[0], scaled[1]], orientation)
             .filter("pad", "ceil(iw/2)*2", "ceil(ih/2)*2")
-            .filter("fps", 30)
+            .filter("fps", tier.fps)
         )
-        out = tmpfile.reserve(".mp4")
         streams = [stacked]
         audios = []
-        if audio1 := maybe_audio(probe1, ffmpeg.input(file1.name)):
+        if audio1 := graph.audio(file1.name, probe1):
             audios.append(audio1)
-        if audio2 := maybe_audio(probe2, ffmpeg.input(file2.name)):
+        if audio2 := graph.audio(file2.name, probe2):
             audios.append(audio2)
         if len(audios) == 1:
             streams.append(audios[0])
         elif len(audios) == 2:
             streams.append(ffmpeg.filter(audios, "amix", dropout_transition=0))
-        try:
-            await ffutil.run(ffmpeg.output(*streams, out))
-            return out
-        except Exception as e:
-            os.remove(out)
-            raise e
-
-    async def edit(self, input: File, edits: Edits) -> str:
-        probe = await ffutil.probe(input.name)
-        videoprobe = next(
-            (s for s in probe["streams"] if s["codec_type"] == "video"), None
+        # scale2ref resizes the first input to match the second one.
+        w1, h1 = dimensions_from_probe(probe1)
+        w2, h2 = dimensions_from_probe(probe2)
+        if orientation == "vstack":
+            width, height = w2, h2 + w2 * h1 // w1
+        else:
+            width, height = w2 + h2 * w1 // h1, h2
+        fit = None
+        if duration is not None:
+            fit = self.fit(
+                probe2,
+                duration=duration,
+                width=width,
+                height=height,
+                has_audio=bool(audios),
+            )
+        return await self.encode(
+            streams, ".mp4", admission.priority or Priority.VIDEO, fit=fit, tier=tier
         )
-        if videoprobe is None:
-            raise Exception("no video stream")
-        duration = float(videoprobe["duration"])
-        input = ffmpeg.input(input.name)
-        video = input.video
-        ogvid = video
-        audio = maybe_audio(probe, input)
-        now = datetime.datetime.now()
-        if edits.start or edits.end:
-            if edits.start:
-                start = edits.start
-            else:
-                start = 0
-            if edits.end:
-                end = edits.end
-            else:
-                end = duration
-            if start > end:
-                raise commands.BadArgument("Start time must be before end time")
-            video = video.filter("trim", start=start, end=end)
-            if audio:
-                audio = audio.filter("atrim", start=start, end=end)
-            duration = end - start
-        if edits.mute:
-            audio = None
-        if audio and edits.volume:
-            audio = audio.filter("volume", edits.volume)
-        if edits.music:
-            with yt_dlp.YoutubeDL() as ydl:
-                info = ydl.extract_info("ytsearch:" + edits.music, download=False)
-                if len(info["entries"]) == 0:
-                    raise Exception("no results found")
-                entry = info["entries"][0]
-                formats = [
-                    fmt
-                    for fmt in entry["formats"]
-                    if fmt["format_id"] in ["249", "250", "251"]
-                ]
-                if len(formats) == 0:
-                    raise Exception("no audio formats found")
-                format = formats[0]
-                music = ffmpeg.input(format["url"], ss=edits.musicskip).filter(
-                    "volume", edits.musicvolume
-                )
-                if not audio:
-                    audio = ffmpeg.input("anullsrc", f="lavfi", t=duration)
-                if edits.musicdelay:
-                    split = audio.filter_multi_output("asplit", 2)
-                    part1 = (
-                        split[0]
-                        .filter("atrim", end=edits.musicdelay)
-                        .filter("asetpts", "PTS-STARTPTS")
-                    )
-                    part2 = (
-                        split[1]
-                        .filter("atrim", start=edits.musicdelay)
-                        .filter("asetpts", "PTS-STARTPTS")
-                    )
-                    part2merged = ffmpeg.filter(
-                        [part2, music], "amix", duration="first", dropout_transition=0
+
+    async def can_copy_edit(
+        self,
+        input: File,
+        probe: ffutil.Probe,
+        edits: Edits,
+        start: float,
+        duration: Optional[float],
+    ) -> bool:
+        if edits.speed or edits.vreverse or not streamcopy.copyable_video(probe):
+            return False
+        if duration is None or not streamcopy.fits(self.max_output, (probe, duration)):
+            return False
+        # A copy can only start on a keyframe. Anywhere else the video is
+        # re-encoded, but the input seek still skips decoding what's before it.
+        return not start or await streamcopy.on_keyframe(input.name, probe, start)
+
+    @cached_result
+    async def edit(self, input: File, edits: Edits) -> Output:
+        probe = await self.probe(input)
+        if probe.video is None:
+            raise commands.BadArgument("No video stream found")
+        start = edits.start
+        duration = trimmed_duration(edits, probe.duration)
+        # reverse holds every frame until the last one is decoded.
+        op = "reverse" if edits.vreverse else "edit"
+        admission = self.admit(op, cost.work(probe, duration))
+        # The music segment is a local temporary file that has to outlive the
+        # encode.
+        async with contextlib.AsyncExitStack() as stack:
+            music = None
+            if edits.music:
+                needed = None
+                if duration is not None:
+                    needed = max(duration - edits.musicdelay, 0)
+                try:
+                    music = await stack.enter_async_context(
+                        self.music.segment(edits.music, edits.musicskip, needed)
                     )
-                    audio = ffmpeg.filter([part1, part2merged], "concat", n=2, v=0, a=1)
-                else:
-                    audio = ffmpeg.filter(
-                        [audio, music], "amix", duration="first", dropout_transition=0
+                except musicutil.MusicError as e:
+                    raise commands.BadArgument(str(e))
+            if await self.can_copy_edit(input, probe, edits, start, duration):
+                streams, kwargs, plan = edit_streams(
+                    input.name, probe, edits, duration, music, copy_video=True
+                )
+                if out := await self.try_copy(streams, plan, shortest=None, **kwargs):
+                    return out
+            streams, kwargs, _ = edit_streams(
+                input.name,
+                probe,
+                edits,
+                duration,
+                music,
+                copy_video=False,
+                scale=admission.scale,
+            )
+            width, height = scaled_dimensions(
+                *dimensions_from_probe(probe), admission.scale
+            )
+            fit = None
+            if duration is not None:
+                fit = self.fit(
+                    probe,
+                    duration=duration / (edits.speed or 1),
+                    width=width,
+                    height=height,
+                    has_audio=len(streams) > 1,
+                )
+            return await self.encode(
+                streams,
+                ".mp4",
+                admission.priority or Priority.VIDEO,
+                fit=fit,
+                shortest=None,
+                **kwargs,
+            )
+
+    @cached_result
+    async def chain(self, input: File, steps: Tuple[Step, ...]) -> Output:
+        """Runs steps with a single decode and a single encode."""
+        ops = [step.op for step in steps]
+        if ops[-1] == "gif":
+            suffix = ".gif"
+            if input.type == "gif":
+                ops.pop()
+        elif input.type == "gif" and not set(ops) <= VIPS_STEPS:
+            # Only vips writes WebP.
+            suffix = await self.output_suffix(input, "mp4")
+        else:
+            suffix = await self.output_suffix(input)
+        if (
+            input.type in ["image", "gif"]
+            and set(ops) <= VIPS_STEPS
+            and suffix != ".mp4"
+        ):
+            return await self.spawn_blocking(
+                vips_chain, input, self.in_memory, suffix, steps[: len(ops)]
+            )
+        return await self.ffmpeg_chain(input, steps, suffix)
+
+    async def ffmpeg_chain(
+        self, input: File, steps: Tuple[Step, ...], suffix: str
+    ) -> Output:
+        probe = await self.probe(input)
+        width, height = dimensions_from_probe(probe)
+        duration = probe.duration
+        seek = {}
+        if steps[0].op == "edit":
+            # Like the edit command, a leading trim seeks the input.
+            duration = trimmed_duration(*steps[0].args, duration)
+            seek = input_seek(*steps[0].args, duration)
+        graph = Graph()
+        video = graph.video(input.name, probe, **seek)
+        audio = graph.audio(input.name, probe, **seek)
+        layers = []
+        stdin = None
+        if any(step.op in LAYER_STEPS for step in steps):
+            sheet, sheet_width, sheet_height, boxes = await self.spawn_blocking(
+                render_layers, width, height, steps
+            )
+            stdin = self.loop.create_future()
+            stdin.set_result(sheet)
+            parts = graph.input(
+                "pipe:0",
+                f="rawvideo",
+                pix_fmt="rgba",
+                s=f"{sheet_width}x{sheet_height}",
+            ).filter_multi_output("split", len(boxes))
+            layers = [
+                (parts[i].filter("crop", w, h, 0, y), h)
+                for i, (w, h, y) in enumerate(boxes)
+            ]
+        for i, step in enumerate(steps):
+            if step.op == "edit":
+                video, audio, duration = apply_edits(
+                    video, audio, duration, *step.args, seeked=i == 0
+                )
+            elif step.op == "crop":
+                w, h, x, y = crop_box(width, height, *step.args)
+                video = video.filter("crop", w, h, x, y)
+                width, height = w, h
+            elif step.op in LAYER_STEPS:
+                layer, layer_height = layers.pop(0)
+                if step.op == "caption":
+                    video = video.filter(
+                        "pad",
+                        width,
+                        height + layer_height,
+                        0,
+                        layer_height,
+                        color="white",
                     )
-                print(f"time to get music: {datetime.datetime.now() - now}")
-        if edits.speed:
-            video = video.filter("setpts", f"{1 / edits.speed}*PTS")
-            if audio:
-                audio = audio.filter("atempo", edits.speed)
-        if edits.vreverse:
-            video = video.filter("reverse")
-        if audio and edits.areverse:
-            audio = audio.filter("areverse")
+                    height += layer_height
+                video = ffmpeg.overlay(video, layer)
+        return await self.encode_chain(
+            input, probe, suffix, video, audio, duration, width, height, stdin
+        )
+
+    async def encode_chain(
+        self,
+        input: File,
+        probe: ffutil.Probe,
+        suffix: str,
+        video,
+        audio,
+        duration: Optional[float],
+        width: int,
+        height: int,
+        stdin: Optional[Awaitable[bytes]] = None,
+    ) -> Output:
+        tier = self.tier()
+        if suffix == ".gif":
+            output = palette_gif(video, width, height, tier)
+            return await self.encode([output], ".gif", stdin=stdin, tier=tier)
+        if suffix == ".png":
+            return await self.encode([video], ".png", Priority.IMAGE, stdin, vframes=1)
+        if input.type != "video":
+            video = video.filter("fps", tier.fps)
+        video = video.filter("pad", "ceil(iw/2)*2", "ceil(ih/2)*2")
         streams = [video]
         if audio:
             streams.append(audio)
-        out = tmpfile.reserve(".mp4")
-        try:
-            kwargs = {}
-            if video is ogvid:
-                kwargs["vcodec"] = "copy"
-            await ffutil.run(ffmpeg.output(*streams, out, shortest=None, **kwargs))
-            print(f"time to ffmpeg: {datetime.datetime.now() - now}")
-            return out
-        except Exception as e:
-            os.remove(out)
-            raise e
+        fit = None
+        if duration is not None:
+            fit = self.fit(
+                probe,
+                duration=duration,
+                width=width + width % 2,
+                height=height + height % 2,
+                has_audio=audio is not None,
+            )
+        return await self.encode(streams, ".mp4", stdin=stdin, fit=fit, tier=tier)
 
-    async def meme(self, input: File, top: str, bottom: str) -> str:
-        return await self.overlay(input, vips.meme, top, bottom)
+    @cached_result
+    async def meme(
+        self, input: File, top: str, bottom: str, format: Optional[str] = None
+    ) -> Output:
+        return await self.overlay(input, format, vips.meme, top, bottom)
 
-    async def caption(self, input: File, caption_text: str) -> str:
-        return await self.spawn_blocking(caption, input, caption_text)
+    @cached_result
+    async def caption(
+        self, input: File, caption_text: str, format: Optional[str] = None
+    ) -> Output:
+        suffix = await self.output_suffix(input, format)
+        if suffix == ".mp4":
+            step = Step("caption", (caption_text,))
+            return await self.ffmpeg_chain(input, (step,), suffix)
+        return await self.spawn_blocking(
+            caption, input, self.in_memory, suffix, caption_text
+        )
@@ -0,0 +1,241 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import secrets
+import shutil
+import typing
+import urllib.parse
+from dataclasses import dataclass
+
+
+@dataclass
+class Entry:
+    path: str
+    digest: str
+    meta: dict
+
+
+def hash_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 16):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_key(key: str) -> str:
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+# Discord signs CDN links with query parameters that change every time a
+# message is fetched. The rest of the query stays part of the key, since on
+# media.discordapp.net width, height and format pick a different rendition.
+CDN_HOSTS = ["cdn.discordapp.com", "media.discordapp.net"]
+SIGNING_PARAMS = {"ex", "is", "hm"}
+
+
+def normalize_url(url: str) -> str:
+    parsed = urllib.parse.urlsplit(url)
+    if parsed.hostname in CDN_HOSTS:
+        query = sorted(
+            (k, v)
+            for k, v in urllib.parse.parse_qsl(parsed.query, keep_blank_values=True)
+            if k not in SIGNING_PARAMS
+        )
+        parsed = parsed._replace(query=urllib.parse.urlencode(query), fragment="")
+    return urllib.parse.urlunsplit(parsed)
+
+
+def link(src: str, dst: str) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class DiskCache:
+    """Content-addressed file store with an LRU byte budget.
+
+    Blobs are stored under their sha256 digest and looked up either directly
+    or through a string key. All mutations are atomic renames and eviction
+    holds an flock, so several processes can share one cache directory.
+    """
+
+    # Eviction frees space down to this share of max_bytes, so a full cache
+    # isn't scanned again on the very next put.
+    low_water = 0.9
+    # Other processes sharing the directory add blobs too, so usage is
+    # rescanned after this many puts even if our own count is under budget.
+    rescan_puts = 64
+
+    def __init__(self, root: str, max_bytes: int) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        # Usage as of the last scan plus what this process added since.
+        self.estimated: typing.Optional[int] = None
+        self.puts = 0
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.key_dir, exist_ok=True)
+
+    @property
+    def blob_dir(self) -> str:
+        return os.path.join(self.root, "blobs")
+
+    @property
+    def key_dir(self) -> str:
+        return os.path.join(self.root, "keys")
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.blob_dir, digest)
+
+    def key_path(self, key: str) -> str:
+        return os.path.join(self.key_dir, hash_key(key))
+
+    @contextlib.contextmanager
+    def lock(self):
+        with open(os.path.join(self.root, ".lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _atomic_write(self, path: str, data: bytes) -> None:
+        tmp = f"{path}.{secrets.token_hex(4)}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def get(self, digest: str) -> typing.Optional[str]:
+        path = self.blob_path(digest)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def lookup(self, key: str) -> typing.Optional[Entry]:
+        try:
+            with open(self.key_path(key), "rb") as f:
+                record = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        path = self.get(record["digest"])
+        if path is None:
+            return None
+        return Entry(path, record["digest"], record["meta"])
+
+    def checkout(self, entry: Entry, dst: str) -> bool:
+        # Hard link the blob so the caller owns a name that survives eviction.
+        try:
+            link(entry.path, dst)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put_file(
+        self,
+        path: str,
+        key: typing.Optional[str] = None,
+        meta: typing.Optional[dict] = None,
+        digest: typing.Optional[str] = None,
+    ) -> Entry:
+        if digest is None:
+            digest = hash_file(path)
+        blob = self.blob_path(digest)
+        added = 0
+        if self.get(digest) is None:
+            tmp = f"{blob}.{secrets.token_hex(4)}.tmp"
+            link(path, tmp)
+            os.replace(tmp, blob)
+            added = os.path.getsize(blob)
+        entry = self._record(digest, key, meta)
+        self._account(added)
+        return entry
+
+    def _record(
+        self, digest: str, key: typing.Optional[str], meta: typing.Optional[dict]
+    ) -> Entry:
+        meta = meta or {}
+        if key is not None:
+            record = json.dumps({"digest": digest, "meta": meta}).encode()
+            self._atomic_write(self.key_path(key), record)
+        return Entry(self.blob_path(digest), digest, meta)
+
+    def _account(self, added: int) -> None:
+        self.puts += 1
+        if self.estimated is not None:
+            self.estimated += added
+        if (
+            self.estimated is None
+            or self.estimated > self.max_bytes
+            or self.puts >= self.rescan_puts
+        ):
+            self.evict()
+
+    def put_bytes(
+        self,
+        data: bytes,
+        key: typing.Optional[str] = None,
+        meta: typing.Optional[dict] = None,
+    ) -> Entry:
+        digest = hashlib.sha256(data).hexdigest()
+        added = 0
+        if self.get(digest) is None:
+            self._atomic_write(self.blob_path(digest), data)
+            added = len(data)
+        entry = self._record(digest, key, meta)
+        self._account(added)
+        return entry
+
+    def usage(self) -> int:
+        total = 0
+        with os.scandir(self.blob_dir) as it:
+            for entry in it:
+                if not entry.name.endswith(".tmp"):
+                    total += entry.stat().st_size
+        return total
+
+    def evict(self) -> None:
+        with self.lock():
+            blobs = []
+            with os.scandir(self.blob_dir) as it:
+                for entry in it:
+                    if entry.name.endswith(".tmp"):
+                        continue
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    blobs.append((st.st_mtime, st.st_size, entry.path))
+            total = sum(size for _, size, _ in blobs)
+            self.puts = 0
+            self.estimated = total
+            if total <= self.max_bytes:
+                return
+            target = self.max_bytes * self.low_water
+            blobs.sort()
+            for _, size, path in blobs:
+                if total <= target:
+                    break
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+                total -= size
+            self.estimated = total
+            self._prune_keys()
+
+    def _prune_keys(self) -> None:
+        with os.scandir(self.key_dir) as it:
+            for entry in it:
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    with open(entry.path, "rb") as f:
+                        digest = json.load(f)["digest"]
+                except (FileNotFoundError, ValueError, KeyError):
+                    digest = None
+                if digest is None or not os.path.exists(self.blob_path(digest)):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(entry.path)
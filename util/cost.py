@@ -0,0 +1,152 @@
+import json
+import math
+import statistics
+from dataclasses import dataclass, replace
+from typing import Optional
+import util.encode as encoding
+import util.ffmpeg as ffutil
+from util.scheduler import Priority
+
+# Scaling a job further down than this makes the output useless, so it's
+# rejected instead.
+MIN_SCALE = 0.25
+# Memory every ffmpeg job needs no matter the input: codecs, buffers and the
+# frames x264 keeps for lookahead.
+BASE_MEMORY = 64 << 20
+PIPELINE_FRAMES = 40
+
+
+class AdmissionError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class Profile:
+    # CPU seconds per megapixel-frame decoded.
+    cpu: float
+    # Bytes each buffered pixel takes in the filter graph.
+    bytes_per_pixel: float
+    # Whether the operation holds every frame at once, like reverse, or the
+    # split that feeds palettegen.
+    buffers_all: bool = False
+    # Whether the operation can run on a downscaled input.
+    scalable: bool = True
+
+
+# Rough defaults for x264 at the normal tier. calibrate() fits them to the
+# host from a bench.processing run.
+PROFILES = {
+    "edit": Profile(0.004, 1.5),
+    "reverse": Profile(0.005, 1.5, buffers_all=True),
+    "gif": Profile(0.012, 4, buffers_all=True),
+    "loopvid": Profile(0.004, 1.5),
+    "stack": Profile(0.006, 1.5, scalable=False),
+}
+
+
+@dataclass
+class Work:
+    width: int
+    height: int
+    frames: float
+
+    @property
+    def megapixel_frames(self) -> float:
+        return self.width * self.height * self.frames / 1e6
+
+
+def work(probe: ffutil.Probe, duration: Optional[float] = None) -> Optional[Work]:
+    """What decoding duration seconds of probe amounts to."""
+    if probe.video is None:
+        return None
+    duration = probe.duration if duration is None else duration
+    if duration is None:
+        return None
+    fps = encoding.parse_rate(probe.video.frame_rate) or 30
+    return Work(probe.video.width, probe.video.height, max(1.0, fps * duration))
+
+
+@dataclass
+class Cost:
+    cpu: float
+    memory: int
+
+
+@dataclass
+class Budget:
+    # Jobs predicted over cpu CPU seconds or memory bytes are downscaled to
+    # fit, or rejected if that isn't possible.
+    cpu: float = 120.0
+    memory: int = 1 << 30
+    # Jobs over defer_cpu wait behind everything else.
+    defer_cpu: float = 30.0
+
+
+@dataclass
+class Admission:
+    action: str = "run"
+    scale: float = 1.0
+    priority: Optional[Priority] = None
+
+
+class Model:
+    def __init__(self, profiles: Optional[dict[str, Profile]] = None) -> None:
+        self.profiles = profiles or PROFILES
+
+    def estimate(self, op: str, *works: Work) -> Cost:
+        profile = self.profiles[op]
+        cpu = sum(w.megapixel_frames for w in works) * profile.cpu
+        memory = BASE_MEMORY
+        for w in works:
+            frames = w.frames
+            if not profile.buffers_all:
+                frames = min(frames, PIPELINE_FRAMES)
+            memory += int(w.width * w.height * profile.bytes_per_pixel * frames)
+        return Cost(cpu, memory)
+
+    def admit(self, op: str, cost: Cost, budget: Budget) -> Admission:
+        """Decides how to run a job of the given cost within budget.
+
+        Both CPU time and buffered memory scale with the pixel count, so a
+        job over budget is scaled by the square root of how far over it is.
+        """
+        scale = min(
+            1.0,
+            math.sqrt(budget.cpu / cost.cpu) if cost.cpu else 1.0,
+            math.sqrt(budget.memory / cost.memory),
+        )
+        if scale < 1.0:
+            if not self.profiles[op].scalable or scale < MIN_SCALE:
+                raise AdmissionError(
+                    "This would take too much time or memory, try a shorter or"
+                    " smaller input"
+                )
+            cost = Cost(cost.cpu * scale**2, int(cost.memory * scale**2))
+        action = "downscale" if scale < 1.0 else "run"
+        if cost.cpu > budget.defer_cpu:
+            action = "defer" if action == "run" else action
+            return Admission(action, scale, Priority.BULK)
+        return Admission(action, scale)
+
+
+def calibrate(
+    path: str, profiles: dict[str, Profile] = PROFILES
+) -> dict[str, Profile]:
+    """Fits each profile's CPU cost to the results of a bench.processing run.
+
+    Cases record the operation and megapixel-frames they were admitted with,
+    so the fitted cost is the median CPU seconds per megapixel-frame.
+    """
+    with open(path) as f:
+        results = json.load(f)["results"]
+    samples: dict[str, list[float]] = {}
+    for r in results:
+        if r.get("cost_op") in profiles and r.get("cost_work"):
+            per_work = r["cpu_s"] / r["cost_work"]
+            samples.setdefault(r["cost_op"], []).append(per_work)
+    return {
+        op: replace(profile, cpu=statistics.median(samples[op]))
+        if op in samples
+        else profile
+        for op, profile in profiles.items()
+    }
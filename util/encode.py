@@ -0,0 +1,137 @@
+import math
+from dataclasses import dataclass
+from typing import Optional
+
+# Share of the budget reserved for the MP4 container and muxing overhead.
+CONTAINER_OVERHEAD = 0.04
+AUDIO_BITRATE = 96_000
+MIN_AUDIO_BITRATE = 32_000
+MIN_VIDEO_BITRATE = 64_000
+# Below this many bits per pixel per frame x264 output turns to mush, so the
+# resolution is reduced instead of the bitrate.
+MIN_BITS_PER_PIXEL = 0.05
+MAX_PASSES = 3
+# Rough size of an animated WebP per pixel per frame, for choosing a format
+# before anything is encoded. A GIF of the same animation is several times
+# larger, and MP4 is smaller still.
+WEBP_BYTES_PER_PIXEL = 0.08
+# libwebp is much slower per frame than x264, so longer or larger animations
+# go to MP4 even when a WebP would fit.
+MAX_WEBP_MEGAPIXEL_FRAMES = 150
+
+
+class BudgetError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class Tier:
+    name: str
+    preset: str
+    fps: int
+    max_dimension: int
+    palette_colors: int
+    dither: str
+
+
+# Indexed by Scheduler.quality_level(), best first.
+TIERS = [
+    Tier("high", "medium", 30, 1920, 256, "sierra2_4a"),
+    Tier("normal", "veryfast", 30, 1280, 256, "bayer"),
+    Tier("low", "ultrafast", 20, 720, 128, "bayer"),
+]
+
+
+@dataclass
+class Source:
+    duration: float
+    width: int
+    height: int
+    fps: float = 30
+    has_audio: bool = True
+    max_dimension: Optional[int] = None
+
+
+@dataclass
+class Target:
+    video_bitrate: int
+    audio_bitrate: int
+    width: int
+    height: int
+    scale: float = 1.0
+
+    def output_args(self) -> dict:
+        args = {
+            "vcodec": "libx264",
+            "crf": 23,
+            "maxrate": self.video_bitrate,
+            "bufsize": self.video_bitrate,
+            "pix_fmt": "yuv420p",
+        }
+        if self.audio_bitrate:
+            args["acodec"] = "aac"
+            args["b:a"] = self.audio_bitrate
+        return args
+
+
+def parse_rate(rate: Optional[str]) -> Optional[float]:
+    if not rate:
+        return None
+    num, _, den = rate.partition("/")
+    try:
+        value = float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return None
+    return value or None
+
+
+def even(n: float) -> int:
+    return max(2, int(n) // 2 * 2)
+
+
+def bound(width: int, height: int, max_dimension: Optional[int]) -> tuple[int, int]:
+    if max_dimension is None or max(width, height) <= max_dimension:
+        return width, height
+    factor = max_dimension / max(width, height)
+    return even(width * factor), even(height * factor)
+
+
+def animated_format(budget: int, width: int, height: int, frames: float) -> str:
+    """Picks the suffix to write an animation in when GIF wasn't asked for.
+
+    WebP keeps transparency and plays like a GIF, so it's used when it's
+    expected to fit comfortably and isn't too slow to encode, and MP4 is
+    used otherwise.
+    """
+    pixels = width * height * frames
+    if (
+        pixels * WEBP_BYTES_PER_PIXEL < budget * 0.9
+        and pixels / 1e6 <= MAX_WEBP_MEGAPIXEL_FRAMES
+    ):
+        return ".webp"
+    return ".mp4"
+
+
+def plan(budget: int, source: Source, scale: float = 1.0) -> Target:
+    bits = budget * 8 * (1 - CONTAINER_OVERHEAD) * scale
+    rate = bits / max(source.duration, 0.1)
+    audio = 0
+    if source.has_audio:
+        audio = int(min(AUDIO_BITRATE, max(MIN_AUDIO_BITRATE, rate * 0.1)))
+    video = int(rate - audio)
+    if video < MIN_VIDEO_BITRATE:
+        raise BudgetError(
+            f"{source.duration:.0f}s of video can't fit in {budget // (1 << 20)} MiB"
+        )
+    width, height = bound(source.width, source.height, source.max_dimension)
+    max_pixels = video / (source.fps * MIN_BITS_PER_PIXEL)
+    if width * height > max_pixels:
+        factor = math.sqrt(max_pixels / (width * height))
+        width, height = width * factor, height * factor
+    return Target(video, audio, even(width), even(height), scale)
+
+
+def shrink(budget: int, source: Source, target: Target, produced: int) -> Target:
+    # Aim a little under the budget so the next pass doesn't land on the edge.
+    ratio = budget / produced * 0.9
+    return plan(budget, source, target.scale * min(ratio, 0.9))
@@ -1,6 +1,13 @@
 import asyncio
 import json
+import os
+import signal
 import ffmpeg
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Awaitable, Optional
+from util.scheduler import Priority, Scheduler
+import util.trace as trace
 
 
 class FFmpegError(Exception):
@@ -17,27 +24,139 @@ class ProbeError(Exception):
         super().__init__(f"FFprobe exited with status {status}: {stderr}")
 
 
-running = 0
+scheduler = Scheduler(os.cpu_count() or 4)
 
 
-async def run(stream_spec) -> None:
-    global running
-    running += 1
-    print(f"Running {running}")
-    args = ffmpeg.compile(stream_spec, overwrite_output=True)
-    proc = await asyncio.create_subprocess_exec(
-        *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+async def spawn(*args, **kwargs) -> asyncio.subprocess.Process:
+    # In a session of its own so that kill() gets anything it starts too.
+    return await asyncio.create_subprocess_exec(
+        *args, start_new_session=True, **kwargs
     )
-    _, stderr = await proc.communicate()
-    running -= 1
-    print(f"Running {running}")
+
+
+def kill(proc: asyncio.subprocess.Process) -> None:
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+async def communicate(
+    proc: asyncio.subprocess.Process, input: Optional[bytes] = None
+) -> tuple[bytes, bytes]:
+    """proc.communicate(), but the process is killed if the caller is
+    cancelled instead of being left to run to completion."""
+    try:
+        return await proc.communicate(input)
+    except BaseException as e:
+        kill(proc)
+        raise e
+
+
+async def run(
+    stream_spec,
+    priority: Priority = Priority.VIDEO,
+    input: Optional[Awaitable[bytes]] = None,
+) -> bytes:
+    args = ffmpeg.compile(stream_spec, overwrite_output=True)
+    stdin = asyncio.subprocess.DEVNULL if input is None else asyncio.subprocess.PIPE
+    async with scheduler.slot(priority):
+        with trace.span("encode"):
+            proc = await spawn(
+                *args,
+                stdin=stdin,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            data = None
+            if input is not None:
+                # ffmpeg is already starting up while the input is produced.
+                try:
+                    data = await input
+                except BaseException as e:
+                    kill(proc)
+                    raise e
+            # The slot is released as soon as ffmpeg is killed on
+            # cancellation; the event loop reaps it in the background.
+            stdout, stderr = await communicate(proc, data)
     if proc.returncode != 0:
         raise FFmpegError(proc.returncode, stderr.decode())
-    return
+    return stdout
+
+
+@dataclass
+class VideoStream:
+    codec: str
+    width: int
+    height: int
+    frame_rate: str
+    duration: Optional[float]
+    pix_fmt: Optional[str]
+
+
+@dataclass
+class AudioStream:
+    codec: str
+    sample_rate: int
+    channels: int
+    duration: Optional[float]
+
+
+def optional_float(value) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass
+class Probe:
+    format: str
+    duration: Optional[float]
+    size: int
+    video: Optional[VideoStream]
+    audio: Optional[AudioStream]
+    raw: dict = field(repr=False)
+    start_time: float = 0.0
+
+    @classmethod
+    def from_json(cls, raw: dict) -> "Probe":
+        video = None
+        audio = None
+        for stream in raw["streams"]:
+            if stream["codec_type"] == "video" and video is None:
+                video = VideoStream(
+                    stream["codec_name"],
+                    stream["width"],
+                    stream["height"],
+                    stream.get("avg_frame_rate", "0/0"),
+                    optional_float(stream.get("duration")),
+                    stream.get("pix_fmt"),
+                )
+            elif stream["codec_type"] == "audio" and audio is None:
+                audio = AudioStream(
+                    stream["codec_name"],
+                    int(stream.get("sample_rate", 0)),
+                    stream.get("channels", 0),
+                    optional_float(stream.get("duration")),
+                )
+        fmt = raw.get("format", {})
+        duration = optional_float(fmt.get("duration"))
+        if duration is None and video is not None:
+            duration = video.duration
+        return cls(
+            fmt.get("format_name", ""),
+            duration,
+            int(fmt.get("size", 0)),
+            video,
+            audio,
+            raw,
+            optional_float(fmt.get("start_time")) or 0.0,
+        )
 
 
-async def probe(filename: str) -> dict:
-    proc = await asyncio.create_subprocess_exec(
+async def probe_raw(filename: str) -> dict:
+    proc = await spawn(
         "ffprobe",
         "-show_format",
         "-show_streams",
@@ -47,7 +166,69 @@ async def probe(filename: str) -> dict:
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE,
     )
-    stdout, stderr = await proc.communicate()
+    stdout, stderr = await communicate(proc)
     if proc.returncode != 0:
         raise ProbeError(proc.returncode, stderr.decode())
     return json.loads(stdout)
+
+
+async def keyframes(filename: str, start: float, end: float) -> list[float]:
+    """Timestamps of the video keyframes between start and end.
+
+    Only packet headers are read, nothing is decoded.
+    """
+    proc = await spawn(
+        "ffprobe",
+        "-v",
+        "error",
+        "-select_streams",
+        "v:0",
+        "-read_intervals",
+        f"{max(start, 0)}%{end}",
+        "-show_entries",
+        "packet=pts_time,flags",
+        "-of",
+        "csv=p=0",
+        filename,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await communicate(proc)
+    if proc.returncode != 0:
+        raise ProbeError(proc.returncode, stderr.decode())
+    times = []
+    for line in stdout.decode().splitlines():
+        pts, _, flags = line.partition(",")
+        if "K" in flags and (t := optional_float(pts)) is not None:
+            times.append(t)
+    return times
+
+
+PROBE_CACHE_SIZE = 1024
+probe_cache: "OrderedDict[tuple, Probe]" = OrderedDict()
+
+
+def probe_key(filename: str, digest: Optional[str]) -> Optional[tuple]:
+    if digest is not None:
+        return ("digest", digest)
+    if "://" in filename:
+        # Remote content can change under the same URL.
+        return None
+    st = os.stat(filename)
+    return ("file", st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+async def probe(filename: str, digest: Optional[str] = None) -> Probe:
+    key = probe_key(filename, digest)
+    if key is None:
+        with trace.span("probe"):
+            return Probe.from_json(await probe_raw(filename))
+    if (cached := probe_cache.get(key)) is not None:
+        probe_cache.move_to_end(key)
+        return cached
+    with trace.span("probe"):
+        result = Probe.from_json(await probe_raw(filename))
+    probe_cache[key] = result
+    if len(probe_cache) > PROBE_CACHE_SIZE:
+        probe_cache.popitem(last=False)
+    return result
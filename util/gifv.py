@@ -0,0 +1,101 @@
+import asyncio
+import html
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+import aiohttp
+
+# The tags we want are in the page's head, so there's no need to read more.
+MAX_PAGE_BYTES = 512 << 10
+
+TAG = re.compile(r"<(?:meta|link)\s[^>]*>", re.IGNORECASE)
+ATTR = re.compile(r"""([\w:-]+)\s*=\s*(?:"([^"]*)"|'([^']*)')""")
+
+VIDEO_PROPERTIES = ["og:video:secure_url", "og:video:url", "og:video"]
+IMAGE_PROPERTIES = ["image_src", "og:image:secure_url", "og:image"]
+
+
+class GifvError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class Renditions:
+    video: Optional[str] = None
+    gif: Optional[str] = None
+
+    def pick(self, allowed_types: Optional[list] = None) -> Optional[str]:
+        """The MP4 if allowed, since ffmpeg decodes it far faster than a GIF
+        and it's a fraction of the size, otherwise the GIF."""
+        if self.video and (allowed_types is None or "video" in allowed_types):
+            return self.video
+        return self.gif
+
+
+def parse(page: str) -> Renditions:
+    found: dict[str, str] = {}
+    for tag in TAG.finditer(page):
+        attrs = {
+            k.lower(): html.unescape(v if v else alt)
+            for k, v, alt in ATTR.findall(tag.group())
+        }
+        key = attrs.get("property") or attrs.get("name") or attrs.get("rel")
+        value = attrs.get("content") or attrs.get("href")
+        if key and value and value.startswith("http"):
+            found.setdefault(key.lower(), value)
+    video = next((found[p] for p in VIDEO_PROPERTIES if p in found), None)
+    images = [found[p] for p in IMAGE_PROPERTIES if p in found]
+    gif = next((i for i in images if ".gif" in i), None)
+    return Renditions(video, gif)
+
+
+class Resolver:
+    """Maps gifv pages (Tenor, Giphy, Imgur, ...) to the media they show.
+
+    Pages are scraped for their OpenGraph tags, and results are kept for ttl
+    seconds so a popular GIF posted over and over is only looked up once.
+    """
+
+    def __init__(
+        self, session: aiohttp.ClientSession, ttl: float = 3600, size: int = 1024
+    ) -> None:
+        self.session = session
+        self.ttl = ttl
+        self.size = size
+        self.pages: OrderedDict[str, tuple[float, Renditions]] = OrderedDict()
+        self.inflight: dict[str, asyncio.Future] = {}
+
+    async def resolve(self, url: str) -> Renditions:
+        if (cached := self.pages.get(url)) is not None:
+            expires, renditions = cached
+            if time.monotonic() < expires:
+                self.pages.move_to_end(url)
+                return renditions
+            del self.pages[url]
+        if (fut := self.inflight.get(url)) is None:
+            fut = asyncio.ensure_future(self.scrape(url))
+            self.inflight[url] = fut
+            fut.add_done_callback(lambda _: self.inflight.pop(url, None))
+        renditions = await asyncio.shield(fut)
+        self.pages[url] = (time.monotonic() + self.ttl, renditions)
+        while len(self.pages) > self.size:
+            self.pages.popitem(last=False)
+        return renditions
+
+    async def scrape(self, url: str) -> Renditions:
+        try:
+            async with self.session.get(url) as resp:
+                resp.raise_for_status()
+                body = b""
+                async for chunk in resp.content.iter_chunked(1 << 16):
+                    body += chunk
+                    if b"</head>" in body or len(body) >= MAX_PAGE_BYTES:
+                        break
+        except aiohttp.ClientError as e:
+            raise GifvError(f"Couldn't load {url}: {e}")
+        renditions = parse(body.decode(errors="replace"))
+        if renditions.video is None and renditions.gif is None:
+            raise GifvError(f"No media found on {url}")
+        return renditions
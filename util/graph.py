@@ -0,0 +1,43 @@
+from typing import Any, Optional
+import ffmpeg
+import util.ffmpeg as ffutil
+
+
+class MissingStreamError(Exception):
+    pass
+
+
+class Graph:
+    """Builds an ffmpeg graph in which every input is opened once.
+
+    ffmpeg demuxes each -i separately, so taking video and audio from two
+    ffmpeg.input() calls for the same file reads it twice. Inputs here are
+    shared by name and options, and streams are checked against the input's
+    probe so a graph that can't work fails before ffmpeg is started.
+    """
+
+    def __init__(self) -> None:
+        self.inputs: dict[tuple, Any] = {}
+
+    def input(self, name: str, **kwargs):
+        # ffmpeg-python turns an option set to None into a bare flag.
+        kwargs = {k: v for k, v in kwargs.items() if v is not None}
+        key = (name, tuple(sorted(kwargs.items())))
+        if (input := self.inputs.get(key)) is None:
+            input = ffmpeg.input(name, **kwargs)
+            self.inputs[key] = input
+        return input
+
+    def video(self, name: str, probe: Optional[ffutil.Probe] = None, **kwargs):
+        if probe is not None and probe.video is None:
+            raise MissingStreamError("Input has no video stream")
+        return self.input(name, **kwargs).video
+
+    def audio(self, name: str, probe: Optional[ffutil.Probe] = None, **kwargs):
+        """The input's audio, or None if its probe found none."""
+        if probe is not None and probe.audio is None:
+            return None
+        return self.input(name, **kwargs).audio
+
+    def silence(self, duration: Optional[float] = None):
+        return self.input("anullsrc", f="lavfi", t=duration)
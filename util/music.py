@@ -0,0 +1,152 @@
+import asyncio
+import contextlib
+import os
+import time
+from dataclasses import dataclass
+from typing import Optional
+import yt_dlp
+import util.cache as cache
+import util.ffmpeg as ffutil
+import util.tmpfile as tmpfile
+import util.trace as trace
+
+# YouTube's opus-in-webm audio formats, lowest bitrate first.
+AUDIO_FORMATS = ["249", "250", "251"]
+
+
+class MusicError(Exception):
+    pass
+
+
+@dataclass
+class Track:
+    id: str
+    title: str
+    url: str
+    resolved_at: float
+
+
+def search(query: str) -> Track:
+    with yt_dlp.YoutubeDL({"quiet": True}) as ydl:
+        info = ydl.extract_info("ytsearch:" + query, download=False)
+    if len(info["entries"]) == 0:
+        raise MusicError("No music results found")
+    entry = info["entries"][0]
+    formats = [fmt for fmt in entry["formats"] if fmt["format_id"] in AUDIO_FORMATS]
+    if len(formats) == 0:
+        raise MusicError("No audio formats found")
+    return Track(entry["id"], entry.get("title", ""), formats[0]["url"], time.time())
+
+
+class Music:
+    """Resolves music searches and keeps local copies of the audio used.
+
+    Searches are cached for ttl seconds, which is well within the lifetime of
+    YouTube's signed format URLs. Segments are downloaded with ffmpeg stream
+    copy into a DiskCache keyed by track and start offset, so the encode reads
+    a local file and popular tracks skip the network entirely.
+    """
+
+    def __init__(
+        self,
+        audio_cache: Optional[cache.DiskCache] = None,
+        ttl: float = 3600,
+        min_segment: float = 60,
+    ) -> None:
+        self.cache = audio_cache
+        self.ttl = ttl
+        self.min_segment = min_segment
+        self.tracks: dict[str, Track] = {}
+        self.inflight: dict[str, asyncio.Future] = {}
+
+    async def resolve(self, query: str) -> Track:
+        query = query.strip().lower()
+        track = self.tracks.get(query)
+        if track is not None and time.time() - track.resolved_at < self.ttl:
+            return track
+        if (fut := self.inflight.get(query)) is None:
+            # yt_dlp blocks on network I/O for seconds, keep it off the loop.
+            fut = asyncio.ensure_future(asyncio.to_thread(search, query))
+            self.inflight[query] = fut
+            fut.add_done_callback(lambda _: self.inflight.pop(query, None))
+        track = await asyncio.shield(fut)
+        self.tracks[query] = track
+        for key, cached in list(self.tracks.items()):
+            if time.time() - cached.resolved_at >= self.ttl:
+                del self.tracks[key]
+        return track
+
+    async def download(self, track: Track, skip: float, length: float) -> str:
+        out = tmpfile.reserve(".webm")
+        proc = await ffutil.spawn(
+            "ffmpeg",
+            "-y",
+            "-loglevel",
+            "error",
+            "-ss",
+            str(skip),
+            "-t",
+            str(length),
+            "-i",
+            track.url,
+            "-vn",
+            "-c:a",
+            "copy",
+            out,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            _, stderr = await ffutil.communicate(proc)
+        except BaseException as e:
+            os.remove(out)
+            raise e
+        if proc.returncode != 0:
+            os.remove(out)
+            raise MusicError(f"Failed to download music: {stderr.decode()}")
+        return out
+
+    async def local(self, track: Track, skip: float, length: Optional[float]) -> str:
+        length = max(length or 0, self.min_segment)
+        key = f"music:{track.id}:{skip:g}"
+        path = tmpfile.unused(".webm")
+        entry = self.cache.lookup(key)
+        if (
+            entry is not None
+            and entry.meta["length"] >= length
+            and self.cache.checkout(entry, path)
+        ):
+            return path
+        with trace.span("music_download"):
+            downloaded = await self.download(track, skip, length)
+        try:
+            await asyncio.to_thread(
+                self.cache.put_file, downloaded, key, {"length": length}
+            )
+        finally:
+            os.replace(downloaded, path)
+        return path
+
+    @contextlib.asynccontextmanager
+    async def segment(self, query: str, skip: float, length: Optional[float]):
+        """Yields (source, offset) for the audio of query starting at skip.
+
+        With a cache, source is a local copy of at least length seconds that
+        already starts at skip. Without one it's the remote URL, to be read
+        from offset.
+        """
+        with trace.span("music"):
+            track = await self.resolve(query)
+            if self.cache is None:
+                path = None
+            else:
+                path = await self.local(track, skip, length)
+        if path is None:
+            yield track.url, skip
+            return
+        try:
+            yield path, 0
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
@@ -0,0 +1,191 @@
+import asyncio
+import concurrent.futures as futures
+import functools
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from typing import Optional
+
+log = logging.getLogger(__name__)
+
+# Set in each worker by warm(); tasks report their start time on it.
+started: Optional[multiprocessing.Queue] = None
+
+
+def core_count() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def warm(
+    start_queue: multiprocessing.Queue,
+    vips_concurrency: int,
+    cache_max: int,
+    cache_max_mem: int,
+) -> None:
+    global started
+    started = start_queue
+    # Must happen before libvips initializes, which is on first import.
+    os.environ["VIPS_CONCURRENCY"] = str(vips_concurrency)
+    import pyvips
+    import ffmpeg
+    import yt_dlp
+    import processing
+    import util.vips
+
+    if hasattr(pyvips, "concurrency_set"):
+        pyvips.concurrency_set(vips_concurrency)
+    pyvips.cache_set_max(cache_max)
+    pyvips.cache_set_max_mem(cache_max_mem)
+    # Loads fontconfig's cache and both fonts, and runs the text and outline
+    # pipelines once so their operations are already built.
+    util.vips.caption(64, "warm").write_to_memory()
+    util.vips.meme(64, 64, "warm", "").write_to_memory()
+    util.vips.caption_text.cache_clear()
+    util.vips.meme_text.cache_clear()
+
+
+def ping() -> int:
+    return os.getpid()
+
+
+def call(task: int, fn, /, *args, **kwargs):
+    # CLOCK_MONOTONIC is system-wide, so the parent can compare this directly.
+    started.put((task, time.monotonic()))
+    return fn(*args, **kwargs)
+
+
+class WorkerPool(futures.Executor):
+    """A process pool that warms its workers and replaces itself when broken.
+
+    Workers are spawned rather than forked, since forking a process that has
+    already started libvips' threads is unsafe. A health check pings the pool
+    periodically and recycles it if a worker died, the ping times out, or a
+    task has been running for longer than max_task_seconds. A task's age
+    counts from when a worker picked it up, not from when it was submitted,
+    so jobs waiting behind a busy pool aren't mistaken for wedged ones.
+    """
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        per_core: float = 1.0,
+        vips_concurrency: int = 1,
+        cache_max: int = 100,
+        cache_max_mem: int = 64 << 20,
+        health_interval: float = 30,
+        health_timeout: float = 10,
+        max_task_seconds: float = 300,
+    ) -> None:
+        self.workers = workers or max(1, round(core_count() * per_core))
+        self.initargs = (vips_concurrency, cache_max, cache_max_mem)
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.max_task_seconds = max_task_seconds
+        self.lock = threading.Lock()
+        self.tasks = itertools.count()
+        # Task id to the time a worker started it, or None while it's queued.
+        self.running: dict[int, Optional[float]] = {}
+        self.started: multiprocessing.Queue
+        self.health: Optional[asyncio.Task] = None
+        self.executor = self.spawn()
+
+    def spawn(self) -> futures.ProcessPoolExecutor:
+        context = multiprocessing.get_context("spawn")
+        self.started = context.Queue()
+        executor = futures.ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=context,
+            initializer=warm,
+            initargs=(self.started, *self.initargs),
+        )
+        # Start every worker now instead of on first use.
+        for _ in range(self.workers):
+            executor.submit(ping)
+        return executor
+
+    def submit(self, fn, /, *args, **kwargs) -> futures.Future:
+        task = next(self.tasks)
+        with self.lock:
+            self.running[task] = None
+        try:
+            executor = self.executor
+            future = executor.submit(call, task, fn, *args, **kwargs)
+        except futures.BrokenExecutor:
+            if self.executor is executor:
+                self.replace("worker died")
+            with self.lock:
+                self.running[task] = None
+            future = self.executor.submit(call, task, fn, *args, **kwargs)
+        future.add_done_callback(functools.partial(self.done, task))
+        return future
+
+    def done(self, task: int, future: futures.Future) -> None:
+        with self.lock:
+            self.running.pop(task, None)
+
+    def collect(self) -> None:
+        """Records the start times workers have reported since the last call."""
+        while True:
+            try:
+                task, start = self.started.get_nowait()
+            except queue.Empty:
+                return
+            with self.lock:
+                if task in self.running:
+                    self.running[task] = start
+
+    def replace(self, reason: str) -> None:
+        log.warning("Replacing worker pool: %s", reason)
+        with self.lock:
+            old, self.executor = self.executor, self.spawn()
+            self.running.clear()
+        # Kill the old workers so a wedged task can't keep its CPU.
+        for proc in list(getattr(old, "_processes", {}).values()):
+            proc.kill()
+        old.shutdown(wait=False, cancel_futures=True)
+
+    async def check(self) -> None:
+        self.collect()
+        with self.lock:
+            starts = [start for start in self.running.values() if start is not None]
+            oldest = min(starts, default=None)
+            busy = len(self.running)
+        if oldest is not None and time.monotonic() - oldest > self.max_task_seconds:
+            self.replace("task exceeded max_task_seconds")
+            return
+        if busy >= self.workers:
+            # A ping would just queue behind real work.
+            return
+        try:
+            await asyncio.wait_for(
+                asyncio.wrap_future(self.executor.submit(ping)), self.health_timeout
+            )
+        except futures.BrokenExecutor:
+            self.replace("worker died")
+        except asyncio.TimeoutError:
+            self.replace("health check timed out")
+
+    async def monitor(self) -> None:
+        while True:
+            await asyncio.sleep(self.health_interval)
+            try:
+                await self.check()
+            except Exception:
+                log.exception("Worker pool health check failed")
+
+    def start(self) -> None:
+        if self.health is None:
+            self.health = asyncio.create_task(self.monitor())
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False) -> None:
+        if self.health is not None:
+            self.health.cancel()
+            self.health = None
+        self.executor.shutdown(wait=wait, cancel_futures=cancel_futures)
@@ -0,0 +1,98 @@
+import bisect
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Generic, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+@dataclass
+class Channel(Generic[T]):
+    # Oldest message seen since the channel started being watched. Anything
+    # before it is unknown to the index.
+    first_seen: int
+    seen: int = 0
+    ids: list[int] = field(default_factory=list)
+    items: list[T] = field(default_factory=list)
+
+
+class RecentMedia(Generic[T]):
+    """Remembers the newest media posted in each channel.
+
+    Messages are fed in as they arrive, so finding the media a command refers
+    to doesn't need an API call. Each channel keeps at most per_channel
+    entries, and the least recently active channels are dropped past
+    max_channels. A channel only knows about messages sent after it was
+    first seen; missing tells the caller how much older history is unknown.
+    """
+
+    def __init__(self, per_channel: int = 16, max_channels: int = 10_000) -> None:
+        self.per_channel = per_channel
+        self.max_channels = max_channels
+        self.channels: OrderedDict[int, Channel[T]] = OrderedDict()
+
+    def add(self, channel_id: int, message_id: int, item: Optional[T]) -> None:
+        """Records a newly sent message and its media, if it has any."""
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            channel = self.channels[channel_id] = Channel(message_id)
+            while len(self.channels) > self.max_channels:
+                self.channels.popitem(last=False)
+        else:
+            self.channels.move_to_end(channel_id)
+        channel.seen += 1
+        self.update(channel_id, message_id, item)
+
+    def update(self, channel_id: int, message_id: int, item: Optional[T]) -> None:
+        """Replaces the media of a message, or forgets it if item is None."""
+        channel = self.channels.get(channel_id)
+        if channel is None or message_id < channel.first_seen:
+            return
+        i = bisect.bisect_left(channel.ids, message_id)
+        if i < len(channel.ids) and channel.ids[i] == message_id:
+            if item is None:
+                del channel.ids[i], channel.items[i]
+            else:
+                channel.items[i] = item
+        elif item is not None:
+            channel.ids.insert(i, message_id)
+            channel.items.insert(i, item)
+            if len(channel.ids) > self.per_channel:
+                del channel.ids[0], channel.items[0]
+
+    def remove(self, channel_id: int, message_id: int) -> None:
+        self.update(channel_id, message_id, None)
+
+    def get(self, channel_id: int, message_id: int) -> Optional[T]:
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            return None
+        i = bisect.bisect_left(channel.ids, message_id)
+        if i < len(channel.ids) and channel.ids[i] == message_id:
+            return channel.items[i]
+        return None
+
+    def latest(self, channel_id: int, before: int) -> Optional[T]:
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            return None
+        i = bisect.bisect_left(channel.ids, before)
+        return channel.items[i - 1] if i else None
+
+    def missing(
+        self, channel_id: int, before: int, limit: int
+    ) -> tuple[int, int]:
+        """How far back history would still need to be read.
+
+        Returns the message id to read before and how many messages to read,
+        so that together with what the index saw, roughly limit messages
+        before before are covered. Messages sent after before also count as
+        seen, so the count is 0 once limit messages went by since the channel
+        was first seen.
+        """
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            return before, limit
+        if before <= channel.first_seen:
+            return before, limit
+        return channel.first_seen, max(0, limit - channel.seen)
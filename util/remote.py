@@ -0,0 +1,332 @@
+import asyncio
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Optional
+import discord.ext.commands as commands
+import processing
+import util.tmpfile as tmpfile
+import util.trace as trace
+from util.scheduler import Job, Priority, current_job, time_left
+
+log = logging.getLogger(__name__)
+
+# Every message is a 4 byte big endian length and that much JSON, optionally
+# followed by raw file contents whose sizes the message announces:
+#
+#   worker -> bot  hello   {limit, running, queued}
+#   bot -> worker  job     {token, op, args, timeout, guild, user, priority,
+#                           files: [{type, digest, size}]}
+#   worker -> bot  need    {files: [index]}, then the bot sends those files
+#   worker -> bot  result  {suffix, plan, size}, then the output
+#                  error   {kind, message}
+#
+# A connection carries a single job. Connecting and hanging up after the
+# hello is how the bot polls a worker's load, and hanging up before the
+# result cancels the job.
+MAX_MESSAGE = 1 << 20
+CHUNK_SIZE = 1 << 16
+
+OPERATIONS = {
+    "cut",
+    "gif",
+    "loopvid",
+    "first_frame",
+    "crop",
+    "stack",
+    "edit",
+    "meme",
+    "caption",
+    "chain",
+}
+DATACLASSES = {"Edits": processing.Edits, "Step": processing.Step}
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class RemoteError(Exception):
+    pass
+
+
+class WorkerUnavailableError(Exception):
+    pass
+
+
+async def send(writer: asyncio.StreamWriter, message: dict) -> None:
+    data = json.dumps(message).encode()
+    writer.write(len(data).to_bytes(4, "big") + data)
+    await writer.drain()
+
+
+async def receive(reader: asyncio.StreamReader) -> dict:
+    size = int.from_bytes(await reader.readexactly(4), "big")
+    if size > MAX_MESSAGE:
+        raise ProtocolError(f"Message of {size} bytes is too large")
+    try:
+        return json.loads(await reader.readexactly(size))
+    except ValueError as e:
+        raise ProtocolError(f"Malformed message: {e}")
+
+
+async def send_file(writer: asyncio.StreamWriter, path: str) -> None:
+    with open(path, "rb") as f:
+        await asyncio.get_running_loop().sendfile(writer.transport, f)
+    await writer.drain()
+
+
+async def receive_file(reader: asyncio.StreamReader, size: int, path: str) -> str:
+    """Writes size bytes from reader to path and returns their sha256."""
+    h = hashlib.sha256()
+    with open(path, "wb") as f:
+        while size > 0:
+            chunk = await reader.readexactly(min(size, CHUNK_SIZE))
+            h.update(chunk)
+            f.write(chunk)
+            size -= len(chunk)
+    return h.hexdigest()
+
+
+def encode_arg(arg: Any, files: list) -> Any:
+    if isinstance(arg, processing.File):
+        files.append(arg)
+        return {"file": len(files) - 1}
+    if isinstance(arg, tuple):
+        return {"tuple": [encode_arg(a, files) for a in arg]}
+    if type(arg).__name__ in DATACLASSES:
+        fields = {
+            f.name: encode_arg(getattr(arg, f.name), files)
+            for f in dataclasses.fields(arg)
+        }
+        return {"dataclass": type(arg).__name__, "fields": fields}
+    if isinstance(arg, list):
+        return [encode_arg(a, files) for a in arg]
+    return arg
+
+
+def decode_arg(value: Any, files: list) -> Any:
+    if isinstance(value, list):
+        return [decode_arg(v, files) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if "file" in value:
+        return files[value["file"]]
+    if "tuple" in value:
+        return tuple(decode_arg(v, files) for v in value["tuple"])
+    if (cls := DATACLASSES.get(value.get("dataclass"))) is not None:
+        return cls(**{k: decode_arg(v, files) for k, v in value["fields"].items()})
+    raise ProtocolError(f"Unknown argument {value!r}")
+
+
+@dataclass(eq=False)
+class Worker:
+    host: str
+    port: int
+    # Advertised in the worker's hello.
+    limit: int = 1
+    load: int = 0
+    # Jobs this bot has running on the worker right now.
+    inflight: int = 0
+    down_until: float = 0.0
+
+    @property
+    def address(self) -> str:
+        return f"{self.host}:{self.port}"
+
+    def up(self) -> bool:
+        return time.monotonic() >= self.down_until
+
+    def utilization(self) -> float:
+        return (self.load + self.inflight) / max(self.limit, 1)
+
+
+def job_fields() -> dict:
+    """The current job's fields a worker schedules by."""
+    job = current_job.get() or Job()
+    return {"guild": job.guild, "user": job.user, "priority": job.priority}
+
+
+def job_from_message(message: dict) -> Job:
+    """The worker side of job_fields, so remote jobs still take turns by
+    guild and user."""
+    priority = message.get("priority")
+    job = Job(
+        message.get("guild"),
+        message.get("user"),
+        priority=None if priority is None else Priority(priority),
+    )
+    if (timeout := message.get("timeout")) is not None:
+        job.deadline = time.monotonic() + timeout
+    return job
+
+
+def parse_address(address: str) -> Worker:
+    host, _, port = address.rpartition(":")
+    return Worker(host or "127.0.0.1", int(port))
+
+
+def operation(op: str):
+    async def call(self: "RemoteProcessing", *args) -> processing.Output:
+        return await self.call(op, *args)
+
+    call.__name__ = op
+    return call
+
+
+class RemoteProcessing:
+    """Runs Processing operations on worker processes over TCP.
+
+    Has the same operations as Processing. Each job goes to the least loaded
+    worker that's up; a worker that drops a connection is skipped for
+    down_seconds and the job is retried on another one, up to retries times.
+    Errors raised by the operation itself are not retried.
+    """
+
+    def __init__(
+        self,
+        addresses: list[str],
+        in_memory: bool = True,
+        token: Optional[str] = None,
+        retries: int = 2,
+        down_seconds: float = 10,
+        poll_interval: float = 5,
+    ) -> None:
+        self.workers = [parse_address(a) for a in addresses]
+        self.in_memory = in_memory
+        self.token = token
+        self.retries = retries
+        self.down_seconds = down_seconds
+        self.poll_interval = poll_interval
+        self.poller: Optional[asyncio.Task] = None
+
+    cut = operation("cut")
+    gif = operation("gif")
+    loopvid = operation("loopvid")
+    first_frame = operation("first_frame")
+    crop = operation("crop")
+    stack = operation("stack")
+    edit = operation("edit")
+    meme = operation("meme")
+    caption = operation("caption")
+    chain = operation("chain")
+
+    def pick(self) -> Optional[Worker]:
+        up = [w for w in self.workers if w.up()]
+        return min(up, key=Worker.utilization, default=None)
+
+    def mark_down(self, worker: Worker, error: BaseException) -> None:
+        log.warning("Worker %s failed: %r", worker.address, error)
+        worker.down_until = time.monotonic() + self.down_seconds
+
+    def hello(self, worker: Worker, message: dict) -> None:
+        if message.get("type") != "hello":
+            raise ProtocolError(f"Expected hello, got {message.get('type')}")
+        worker.limit = message["limit"]
+        worker.load = message["running"] + message["queued"]
+
+    async def call(self, op: str, *args) -> processing.Output:
+        files: list[processing.File] = []
+        encoded = [encode_arg(arg, files) for arg in args]
+        for attempt in range(self.retries + 1):
+            worker = self.pick()
+            if worker is None:
+                break
+            try:
+                with trace.span("remote", worker=worker.address, attempt=attempt):
+                    return await self.run(worker, op, encoded, files)
+            except (OSError, asyncio.IncompleteReadError, ProtocolError) as e:
+                self.mark_down(worker, e)
+        raise WorkerUnavailableError("No processing workers are available")
+
+    async def run(
+        self, worker: Worker, op: str, args: list, files: list
+    ) -> processing.Output:
+        reader, writer = await asyncio.open_connection(worker.host, worker.port)
+        worker.inflight += 1
+        try:
+            self.hello(worker, await receive(reader))
+            await send(
+                writer,
+                {
+                    "type": "job",
+                    "token": self.token,
+                    "op": op,
+                    "args": args,
+                    "timeout": time_left(),
+                    **job_fields(),
+                    "files": [
+                        {
+                            "type": f.type,
+                            "digest": f.digest,
+                            "size": os.path.getsize(f.name),
+                        }
+                        for f in files
+                    ],
+                },
+            )
+            reply = await receive(reader)
+            if reply["type"] == "need":
+                for i in reply["files"]:
+                    await send_file(writer, files[i].name)
+                reply = await receive(reader)
+            if reply["type"] == "error":
+                if reply["kind"] == "bad_argument":
+                    raise commands.BadArgument(reply["message"])
+                raise RemoteError(reply["message"])
+            if reply["type"] != "result":
+                raise ProtocolError(f"Unexpected {reply['type']} message")
+            return await self.receive_output(reader, reply)
+        finally:
+            worker.inflight -= 1
+            writer.close()
+
+    async def receive_output(
+        self, reader: asyncio.StreamReader, reply: dict
+    ) -> processing.Output:
+        suffix, plan = reply["suffix"], reply["plan"]
+        if self.in_memory:
+            data = await reader.readexactly(reply["size"])
+            return processing.Output(suffix, data=data, plan=plan)
+        path = tmpfile.reserve(suffix)
+        try:
+            await receive_file(reader, reply["size"], path)
+        except BaseException as e:
+            os.remove(path)
+            raise e
+        return processing.Output(suffix, path=path, plan=plan)
+
+    async def poll(self, worker: Worker) -> None:
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(worker.host, worker.port), self.poll_interval
+            )
+        except (OSError, asyncio.TimeoutError) as e:
+            if worker.up():
+                self.mark_down(worker, e)
+            return
+        try:
+            self.hello(worker, await receive(reader))
+            worker.down_until = 0.0
+        except (OSError, asyncio.IncompleteReadError, ProtocolError) as e:
+            self.mark_down(worker, e)
+        finally:
+            writer.close()
+
+    async def monitor(self) -> None:
+        while True:
+            await asyncio.gather(*(self.poll(w) for w in self.workers))
+            await asyncio.sleep(self.poll_interval)
+
+    def start(self) -> None:
+        if self.poller is None:
+            self.poller = asyncio.create_task(self.monitor())
+
+    def shutdown(self) -> None:
+        if self.poller is not None:
+            self.poller.cancel()
+            self.poller = None
@@ -0,0 +1,251 @@
+import asyncio
+import contextlib
+import contextvars
+import enum
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Callable, Iterator, Optional
+import util.trace as trace
+
+
+class Priority(enum.IntEnum):
+    IMAGE = 0
+    VIDEO = 1
+    # Jobs the cost model expects to be expensive.
+    BULK = 2
+
+
+@dataclass
+class Job:
+    guild: Optional[int] = None
+    user: Optional[int] = None
+    # Called with the 1-based queue position whenever it changes, and with 0
+    # once the job starts running.
+    on_queued: Optional[Callable[[int], None]] = None
+    # time.monotonic() after which the job is cancelled.
+    deadline: Optional[float] = None
+    # If set, none of the job's slots are served ahead of this priority.
+    priority: Optional[Priority] = None
+
+
+current_job: contextvars.ContextVar[Optional[Job]] = contextvars.ContextVar(
+    "current_job", default=None
+)
+
+
+def time_left() -> Optional[float]:
+    """Seconds until the current job's deadline, if it has one."""
+    job = current_job.get()
+    if job is None or job.deadline is None:
+        return None
+    return job.deadline - time.monotonic()
+
+
+@dataclass(eq=False)
+class Waiter:
+    job: Job
+    priority: Priority
+    future: asyncio.Future
+    queued_at: float = field(default_factory=time.monotonic)
+    position: int = 0
+
+
+@dataclass
+class Stats:
+    limit: int
+    running: int
+    queued: int
+    queued_by_priority: dict
+    mean_wait: float
+    max_wait: float
+    pressure: float
+    quality_level: int
+    cancelled: dict
+
+
+class Scheduler:
+    """Limits concurrent jobs and hands out slots fairly.
+
+    Lower priorities are served first. Within a priority, guilds take turns
+    and users within a guild take turns, so one busy user can't starve a
+    guild and one busy guild can't starve the bot.
+    """
+
+    # Load at which quality steps down from level i to i + 1, and at which it
+    # steps back up from i + 1 to i. The gap between them is the hysteresis
+    # that keeps the level from flapping around a single threshold.
+    degrade_at = [1.0, 3.0]
+    recover_at = [0.25, 1.0]
+    # Waits are judged against this many seconds and forgotten after
+    # wait_window seconds.
+    wait_target = 5.0
+    wait_window = 60.0
+
+    def __init__(self, limit: int, wait_samples: int = 256) -> None:
+        self.limit = limit
+        self.running = 0
+        self.queues: dict[Priority, OrderedDict] = {p: OrderedDict() for p in Priority}
+        self.waits: deque[tuple[float, float]] = deque(maxlen=wait_samples)
+        self.level = 0
+        # Cancelled jobs by reason.
+        self.cancellations: dict[str, int] = {}
+
+    def configure(self, limit: int) -> None:
+        self.limit = limit
+        self._dispatch()
+
+    def queued(self) -> int:
+        return sum(
+            len(users)
+            for guilds in self.queues.values()
+            for user_queues in guilds.values()
+            for users in user_queues.values()
+        )
+
+    def _order(self) -> Iterator[Waiter]:
+        # Replays round-robin dispatch on a snapshot of the queues.
+        for priority in Priority:
+            guilds = [
+                [list(q) for q in users.values()]
+                for users in self.queues[priority].values()
+            ]
+            while guilds:
+                for users in list(guilds):
+                    queue = users.pop(0)
+                    yield queue.pop(0)
+                    if queue:
+                        users.append(queue)
+                    if not users:
+                        guilds.remove(users)
+
+    def _pop(self) -> Optional[Waiter]:
+        for priority in Priority:
+            guilds = self.queues[priority]
+            if not guilds:
+                continue
+            guild, users = next(iter(guilds.items()))
+            user, queue = next(iter(users.items()))
+            waiter = queue.popleft()
+            users.pop(user)
+            if queue:
+                users[user] = queue
+            guilds.pop(guild)
+            if users:
+                guilds[guild] = users
+            return waiter
+        return None
+
+    def _remove(self, waiter: Waiter) -> None:
+        guilds = self.queues[waiter.priority]
+        users = guilds.get(waiter.job.guild)
+        if users is None:
+            return
+        queue = users.get(waiter.job.user)
+        if queue is None or waiter not in queue:
+            return
+        queue.remove(waiter)
+        if not queue:
+            del users[waiter.job.user]
+        if not users:
+            del guilds[waiter.job.guild]
+
+    def _notify(self, waiter: Waiter, position: int) -> None:
+        if waiter.position != position:
+            waiter.position = position
+            if waiter.job.on_queued is not None:
+                waiter.job.on_queued(position)
+
+    def _dispatch(self) -> None:
+        while self.running < self.limit:
+            waiter = self._pop()
+            if waiter is None:
+                break
+            if waiter.future.done():
+                continue
+            self.running += 1
+            now = time.monotonic()
+            self.waits.append((now, now - waiter.queued_at))
+            waiter.future.set_result(None)
+            self._notify(waiter, 0)
+        for position, waiter in enumerate(self._order(), 1):
+            self._notify(waiter, position)
+
+    async def acquire(self, priority: Priority) -> None:
+        job = current_job.get() or Job()
+        if job.priority is not None:
+            priority = max(priority, job.priority)
+        if self.running < self.limit and self.queued() == 0:
+            self.running += 1
+            self.waits.append((time.monotonic(), 0))
+            return
+        waiter = Waiter(job, priority, asyncio.get_running_loop().create_future())
+        self.queues[priority].setdefault(job.guild, OrderedDict()).setdefault(
+            job.user, deque()
+        ).append(waiter)
+        self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.release()
+            else:
+                self._remove(waiter)
+                self._dispatch()
+            raise
+
+    def release(self) -> None:
+        self.running -= 1
+        self._dispatch()
+
+    def cancelled(self, reason: str) -> None:
+        self.cancellations[reason] = self.cancellations.get(reason, 0) + 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: Priority = Priority.VIDEO):
+        with trace.span("queue", priority=priority.name.lower()):
+            await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def recent_waits(self) -> list[float]:
+        cutoff = time.monotonic() - self.wait_window
+        return [wait for at, wait in self.waits if at >= cutoff]
+
+    def pressure(self) -> float:
+        waits = self.recent_waits()
+        wait = sum(waits) / len(waits) if waits else 0
+        return max(self.queued() / self.limit, wait / self.wait_target)
+
+    def quality_level(self) -> int:
+        """Returns 0 for best quality, higher levels trade quality for speed."""
+        pressure = self.pressure()
+        while (
+            self.level < len(self.degrade_at)
+            and pressure > self.degrade_at[self.level]
+        ):
+            self.level += 1
+        while self.level > 0 and pressure < self.recover_at[self.level - 1]:
+            self.level -= 1
+        return self.level
+
+    def stats(self) -> Stats:
+        waits = self.recent_waits()
+        return Stats(
+            self.limit,
+            self.running,
+            self.queued(),
+            {
+                p.name.lower(): sum(
+                    len(q) for users in self.queues[p].values() for q in users.values()
+                )
+                for p in Priority
+            },
+            sum(waits) / len(waits) if waits else 0,
+            max(waits, default=0),
+            self.pressure(),
+            self.level,
+            dict(self.cancellations),
+        )
@@ -0,0 +1,84 @@
+from typing import Optional
+import util.ffmpeg as ffutil
+import util.encode as encoding
+
+# Codecs that can be copied into an MP4 as they are and still play in Discord.
+MP4_VIDEO_CODECS = {"h264", "hevc", "av1", "vp9"}
+MP4_AUDIO_CODECS = {"aac", "mp3", "opus"}
+# A copy can't be shrunk to fit, so only try one when it's expected to come
+# out comfortably under the budget.
+BUDGET_MARGIN = 0.9
+
+
+def copyable_video(probe: ffutil.Probe) -> bool:
+    return probe.video is not None and probe.video.codec in MP4_VIDEO_CODECS
+
+
+def copyable_audio(probe: ffutil.Probe) -> bool:
+    return probe.audio is None or probe.audio.codec in MP4_AUDIO_CODECS
+
+
+def copyable(probe: ffutil.Probe) -> bool:
+    return copyable_video(probe) and copyable_audio(probe)
+
+
+def concatable(a: ffutil.Probe, b: ffutil.Probe) -> bool:
+    """Whether b can be appended to a with the concat demuxer and -c copy,
+    which needs every stream's codec parameters to match."""
+    if not (copyable(a) and copyable(b)):
+        return False
+    va, vb = a.video, b.video
+    if (va.codec, va.width, va.height, va.pix_fmt, va.frame_rate) != (
+        vb.codec,
+        vb.width,
+        vb.height,
+        vb.pix_fmt,
+        vb.frame_rate,
+    ):
+        return False
+    if a.audio is None or b.audio is None:
+        return a.audio is None and b.audio is None
+    aa, ab = a.audio, b.audio
+    return (aa.codec, aa.sample_rate, aa.channels) == (
+        ab.codec,
+        ab.sample_rate,
+        ab.channels,
+    )
+
+
+def estimate(probe: ffutil.Probe, duration: float) -> Optional[int]:
+    """Size of duration seconds of the input, assuming a constant bitrate."""
+    if not probe.size or not probe.duration:
+        return None
+    return int(probe.size / probe.duration * duration)
+
+
+def fits(budget: int, *parts: tuple[ffutil.Probe, float]) -> bool:
+    total = 0
+    for probe, duration in parts:
+        if (size := estimate(probe, duration)) is None:
+            return False
+        total += size
+    return total < budget * BUDGET_MARGIN
+
+
+def concat_list(entries: list[tuple[str, Optional[float]]]) -> str:
+    """A concat demuxer script playing each file up to its outpoint."""
+    lines = ["ffconcat version 1.0"]
+    for path, outpoint in entries:
+        quoted = path.replace("'", "'\\''")
+        lines.append(f"file '{quoted}'")
+        if outpoint is not None:
+            lines.append(f"outpoint {outpoint}")
+    return "\n".join(lines) + "\n"
+
+
+async def on_keyframe(filename: str, probe: ffutil.Probe, t: float) -> bool:
+    """Whether an input seek to t lands on a keyframe, so a copy starts
+    exactly there instead of at the keyframe before it."""
+    fps = encoding.parse_rate(probe.video.frame_rate) or 30
+    tolerance = 0.5 / fps
+    # Seeks are relative to the start of the file, packet timestamps aren't.
+    t += probe.start_time
+    keyframes = await ffutil.keyframes(filename, t - tolerance, t + tolerance)
+    return any(abs(k - t) <= tolerance for k in keyframes)
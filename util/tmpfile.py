@@ -1,4 +1,5 @@
 import tempfile
+import secrets
 import os
 
 
@@ -10,3 +11,7 @@ def reserve(suffix: str) -> str:
         except Exception as e:
             os.remove(f.name)
             raise e
+
+
+def unused(suffix: str) -> str:
+    return os.path.join(tempfile.gettempdir(), f"tmp{secrets.token_hex(8)}{suffix}")
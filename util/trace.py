@@ -0,0 +1,157 @@
+import bisect
+import contextlib
+import contextvars
+import json
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+log = logging.getLogger("cinnamon.trace")
+
+BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th quantile."""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else float("inf")
+        return float("inf")
+
+
+# (command, stage) -> latency histogram
+histograms: dict[tuple[str, str], Histogram] = {}
+# (name, labels) -> running total
+counters: dict[tuple[str, tuple], float] = {}
+
+
+@dataclass
+class Span:
+    name: str
+    start: float
+    duration: float = 0.0
+    attrs: dict = field(default_factory=dict)
+
+
+@dataclass
+class Trace:
+    command: str
+    start: float = field(default_factory=time.monotonic)
+    attrs: dict = field(default_factory=dict)
+    spans: list[Span] = field(default_factory=list)
+
+
+current: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar(
+    "trace", default=None
+)
+
+
+def start(command: str, **attrs) -> contextvars.Token:
+    return current.set(Trace(command, attrs=attrs))
+
+
+def annotate(**attrs) -> None:
+    if (trace := current.get()) is not None:
+        trace.attrs.update(attrs)
+
+
+@contextlib.contextmanager
+def span(name: str, **attrs):
+    trace = current.get()
+    if trace is None:
+        yield
+        return
+    s = Span(name, time.monotonic(), attrs=attrs)
+    try:
+        yield s
+    finally:
+        s.duration = time.monotonic() - s.start
+        trace.spans.append(s)
+
+
+def observe(command: str, stage: str, value: float) -> None:
+    key = (command, stage)
+    if key not in histograms:
+        histograms[key] = Histogram()
+    histograms[key].observe(value)
+
+
+def count(name: str, value: float = 1, **labels) -> None:
+    key = (name, tuple(sorted(labels.items())))
+    counters[key] = counters.get(key, 0) + value
+
+
+def finish(token: contextvars.Token, error: Optional[BaseException] = None) -> None:
+    trace = current.get()
+    current.reset(token)
+    if trace is None:
+        return
+    total = time.monotonic() - trace.start
+    stages: dict[str, float] = {}
+    for s in trace.spans:
+        stages[s.name] = stages.get(s.name, 0.0) + s.duration
+    for stage, duration in stages.items():
+        observe(trace.command, stage, duration)
+    observe(trace.command, "total", total)
+    log.info(
+        json.dumps(
+            {
+                "command": trace.command,
+                "total": round(total, 4),
+                "error": type(error).__name__ if error else None,
+                **trace.attrs,
+                "spans": [
+                    {
+                        "name": s.name,
+                        "offset": round(s.start - trace.start, 4),
+                        "duration": round(s.duration, 4),
+                        **s.attrs,
+                    }
+                    for s in trace.spans
+                ],
+            }
+        )
+    )
+
+
+def prometheus() -> str:
+    lines = [
+        "# HELP cinnamon_stage_seconds Time spent in each stage of a command.",
+        "# TYPE cinnamon_stage_seconds histogram",
+    ]
+    for (command, stage), h in sorted(histograms.items()):
+        labels = f'command="{command}",stage="{stage}"'
+        cumulative = 0
+        for bound, count in zip(BUCKETS + [float("inf")], h.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(
+                f'cinnamon_stage_seconds_bucket{{{labels},le="{le}"}} {cumulative}'
+            )
+        lines.append(f"cinnamon_stage_seconds_sum{{{labels}}} {h.sum}")
+        lines.append(f"cinnamon_stage_seconds_count{{{labels}}} {h.count}")
+    typed = set()
+    for (name, labels), value in sorted(counters.items()):
+        if name not in typed:
+            lines.append(f"# TYPE cinnamon_{name}_total counter")
+            typed.add(name)
+        label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+        lines.append(f"cinnamon_{name}_total{{{label_text}}} {value}")
+    return "\n".join(lines) + "\n"
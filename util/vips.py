@@ -2,6 +2,103 @@ import pyvips
 from pyvips import GValue
 from util.tmpfile import reserve as mk_tempfile
 import os
+import functools
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+
+# Discord shows GIFs at most 550 px wide inline; the rest is left for the
+# full size viewer. Anything larger is shrunk while it's being decoded.
+GIF_MAX_DIMENSION = 640
+GIF_MAX_FRAMES = 1000
+# Total pixels over all frames after shrinking, which bounds CPU time.
+GIF_MAX_PIXELS = 200_000_000
+
+
+class LimitError(Exception):
+    pass
+
+
+class DeadlineError(Exception):
+    pass
+
+
+# Wall clock time at which the job running in this worker is given up on.
+deadline: Optional[float] = None
+
+
+def run_until(until: Optional[float], func: Callable, *args, **kwargs):
+    """Runs func in a pool worker with a deadline.
+
+    The job that submitted it may have been cancelled while it sat in the
+    pool's queue, in which case its deadline has usually passed too and it's
+    dropped without starting.
+
+    Returns func's result and the text cache hits and misses it caused, since
+    the caches live in the workers and the bot can't see them otherwise.
+    """
+    global deadline
+    if until is not None and time.time() >= until:
+        raise DeadlineError("Job was abandoned before it started")
+    deadline = until
+    before = {c.name: (c.hits, c.misses) for c in TEXT_CACHES}
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        deadline = None
+    counts = {
+        c.name: (c.hits - before[c.name][0], c.misses - before[c.name][1])
+        for c in TEXT_CACHES
+    }
+    return result, counts
+
+
+def watch(image: pyvips.Image) -> pyvips.Image:
+    """Makes evaluating image fail with pyvips.Error once the deadline
+    passes, instead of running to completion for nobody."""
+    if deadline is None:
+        return image
+    until = deadline
+
+    def check(image: pyvips.Image, progress) -> None:
+        if time.time() >= until:
+            image.set_kill(True)
+
+    image.set_progress(True)
+    image.signal_connect("eval", check)
+    return image
+
+
+def load_gif(
+    filename: str,
+    max_dimension: int = GIF_MAX_DIMENSION,
+    max_frames: int = GIF_MAX_FRAMES,
+    max_pixels: int = GIF_MAX_PIXELS,
+) -> pyvips.Image:
+    """Opens an animated GIF as one tall image to be read top to bottom.
+
+    Frames are decoded as they're needed, so memory is bounded by the
+    pipeline's buffers and not by the number of frames. Frames larger than
+    max_dimension are shrunk as they're decoded.
+    """
+    # Only the header is read here.
+    header = pyvips.Image.new_from_file(filename, access="sequential")
+    pages = header.get("n-pages") if header.get_typeof("n-pages") != 0 else 1
+    if pages > max_frames:
+        raise LimitError(f"GIF has more than {max_frames} frames")
+    width, height = header.width, header.height
+    if max(width, height) > max_dimension:
+        factor = max_dimension / max(width, height)
+        width, height = round(width * factor), round(height * factor)
+        image = pyvips.Image.thumbnail(
+            f"{filename}[n=-1]", width, height=height, size="down"
+        )
+    else:
+        image = pyvips.Image.new_from_file(filename, n=-1, access="sequential")
+    if width * height * pages > max_pixels:
+        raise LimitError("GIF is too large")
+    return image
 
 
 def outline(img: pyvips.Image, radius: int) -> pyvips.Image:
@@ -12,59 +109,149 @@ def outline(img: pyvips.Image, radius: int) -> pyvips.Image:
     img = img[3].convsep(mask).cast("uchar")
     return img.new_from_image([0, 0, 0]).bandjoin(img)
 
-def caption(width: int, text: str) -> pyvips.Image:
+
+# Rendered text layers are kept per worker process, keyed by everything that
+# affects the rendering, so repeated captions skip Pango and the outline blur.
+TEXT_CACHE_BYTES = 32 << 20
+
+FORMAT_BYTES = {
+    "uchar": 1,
+    "char": 1,
+    "ushort": 2,
+    "short": 2,
+    "uint": 4,
+    "int": 4,
+    "float": 4,
+    "complex": 8,
+    "double": 8,
+    "dpcomplex": 16,
+}
+
+
+class TextCache:
+    """An LRU cache of rendered images, bounded by their size in memory
+    rather than their number, since a layer 1920 px wide is far larger than
+    one for a thumbnail."""
+
+    def __init__(self, func: Callable, max_bytes: int = TEXT_CACHE_BYTES) -> None:
+        functools.update_wrapper(self, func)
+        self.func = func
+        self.name = func.__name__
+        self.max_bytes = max_bytes
+        self.images: OrderedDict[tuple, pyvips.Image] = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, *key) -> pyvips.Image:
+        if (image := self.images.get(key)) is not None:
+            self.images.move_to_end(key)
+            self.hits += 1
+            return image
+        self.misses += 1
+        image = self.func(*key)
+        size = nbytes(image)
+        if size > self.max_bytes:
+            return image
+        self.images[key] = image
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, evicted = self.images.popitem(last=False)
+            self.bytes -= nbytes(evicted)
+        return image
+
+    def cache_clear(self) -> None:
+        self.images.clear()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+
+def nbytes(image: pyvips.Image) -> int:
+    return image.width * image.height * image.bands * FORMAT_BYTES[image.format]
+
+
+@TextCache
+def caption_text(text: str, font: str, width: int) -> pyvips.Image:
     text = pyvips.Image.text(
         text,
         rgba=True,
         align="centre",
-        # TODO use Futura
-        font=f'DejaVu Sans {width//10}',
+        font=font,
         width=width,
     )
     text = text.new_from_image([0,0,0]).bandjoin(text[3])
     text = text.gravity("centre", width, text.height + width//10)
     text = text.new_from_image([255,255,255]).composite2(text, "over")
+    return text.copy_memory()
 
-    return text
+
+def caption(width: int, text: str) -> pyvips.Image:
+    # TODO use Futura
+    return caption_text(text, f'DejaVu Sans {width//10}', width)
 
 
 def vstack(top: pyvips.Image, img: pyvips.Image) -> pyvips.Image:
-    caption_height = top.height
-    top = top.embed(0, 0, img.width, img.height + caption_height, extend="black")
     if not img.hasalpha():
         img = img.bandjoin(255)
-    replicated = top.replicate(1, img.get_n_pages())
+    top = top.cast(img.format)
     page_height = img.get_page_height()
-    for i in range(img.get_n_pages()):
-        frame = img.crop(0, i * page_height, img.width, page_height)
-        replicated = replicated.insert(frame, 0, i * top.height + caption_height)
-    replicated.set_type(GValue.gint_type, 'page-height', top.height)
-    return replicated
+    # A single arrayjoin of the pages keeps the graph the same depth no
+    # matter how many frames there are. arrayjoin pads every tile to the
+    # largest one, so each page is joined first and the tiles are all the
+    # same size.
+    pages = [
+        top.join(img.crop(0, i * page_height, img.width, page_height), "vertical")
+        for i in range(img.get_n_pages())
+    ]
+    stacked = pyvips.Image.arrayjoin(pages, across=1).copy()
+    stacked.set_type(GValue.gint_type, "page-height", top.height + page_height)
+    for name in ["delay", "loop"]:
+        if img.get_typeof(name) != 0:
+            stacked.set_type(img.get_typeof(name), name, img.get(name))
+    return stacked
 
 
-def meme(width: int, height: int, top: str, bottom: str) -> pyvips.Image:
-    size = width // 14
+def crop(
+    img: pyvips.Image, left: int, top: int, width: int, height: int
+) -> pyvips.Image:
+    """Crops every page of a possibly animated image the same way."""
+    page_height = img.get_page_height()
+    pages = [
+        img.crop(left, i * page_height + top, width, height)
+        for i in range(img.get_n_pages())
+    ]
+    cropped = pyvips.Image.arrayjoin(pages, across=1).copy()
+    cropped.set_type(GValue.gint_type, "page-height", height)
+    for name in ["delay", "loop"]:
+        if img.get_typeof(name) != 0:
+            cropped.set_type(img.get_typeof(name), name, img.get(name))
+    return cropped
+
+
+@TextCache
+def meme_text(text: str, font: str, width: int, height: int, dpi: int) -> pyvips.Image:
     rad = max(1, width / 1000)
+    text = pyvips.Image.text(
+        text,
+        font=font,
+        width=width * 0.95,
+        height=height * 0.95 / 3,
+        align="centre",
+        rgba=True,
+        dpi=dpi,
+    )
+    text = text.new_from_image([255, 255, 255]).bandjoin(text[3])
+    text = outline(text, rad).composite2(text, "over", x=rad, y=rad)
+    pad = width / 20
+    text = text.embed(pad, pad, text.width + pad * 2, text.height + pad * 2)
+    return text.copy_memory()
 
-    def meme_text(text: str) -> pyvips.Image | None:
-        if text == "":
-            return None
-        text = pyvips.Image.text(
-            text,
-            font=f"Impact Bold {width/9}",
-            width=width * 0.95,
-            height=height * 0.95 / 3,
-            align="centre",
-            rgba=True,
-            dpi=72,
-        )
-        text = text.new_from_image([255, 255, 255]).bandjoin(text[3])
-        text = outline(text, rad).composite2(text, "over", x=rad, y=rad)
-        pad = width / 20
-        return text.embed(pad, pad, text.width + pad * 2, text.height + pad * 2)
 
-    toptext = meme_text(top)
-    bottomtext = meme_text(bottom)
+def meme(width: int, height: int, top: str, bottom: str) -> pyvips.Image:
+    font = f"Impact Bold {width/9}"
+    toptext = meme_text(top, font, width, height, 72) if top else None
+    bottomtext = meme_text(bottom, font, width, height, 72) if bottom else None
     text: None | pyvips.Image = None
     if toptext is not None:
         text = toptext.gravity("north", width, height)
@@ -77,6 +264,15 @@ def meme(width: int, height: int, top: str, bottom: str) -> pyvips.Image:
     return text
 
 
+TEXT_CACHES = [caption_text, meme_text]
+
+
+def to_rgba(image: pyvips.Image) -> pyvips.Image:
+    if image.bands == 3:
+        image = image.bandjoin(255)
+    return image.cast("uchar")
+
+
 def dimensions(file: str) -> tuple[int, int]:
     img = pyvips.Image.new_from_file(file)
     return img.width, img.get_page_height()
@@ -85,7 +281,8 @@ def dimensions(file: str) -> tuple[int, int]:
 def write_image(image: pyvips.Image, suffix: str) -> str:
     tf = mk_tempfile(suffix)
     try:
-        image.write_to_file(tf)
+        watch(image).write_to_file(tf)
         return tf
     except Exception as e:
         os.remove(tf)
+        raise e
@@ -0,0 +1,223 @@
+# Runs Processing operations for a bot configured with remote_workers.
+#
+#   python -m worker [--host 127.0.0.1] [--port 7100] [--max-jobs N] [--token T]
+#
+# Start several on different ports to test with more than one worker on a
+# single machine. See util/remote.py for the protocol.
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+from typing import Optional
+import discord.ext.commands as commands
+import processing
+import util.cache as cache
+import util.cost as cost
+import util.ffmpeg as ffutil
+import util.music as musicutil
+import util.pool as pool
+import util.remote as remote
+import util.scheduler as scheduler
+import util.tmpfile as tmpfile
+
+log = logging.getLogger("cinnamon.worker")
+
+
+class Server:
+    def __init__(
+        self,
+        proc: processing.Processing,
+        inputs: cache.DiskCache,
+        token: Optional[str] = None,
+    ) -> None:
+        self.processing = proc
+        self.inputs = inputs
+        self.token = token
+
+    def hello(self) -> dict:
+        stats = ffutil.scheduler.stats()
+        return {
+            "type": "hello",
+            "limit": stats.limit,
+            "running": stats.running,
+            "queued": stats.queued,
+        }
+
+    async def receive_inputs(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        specs: list,
+        paths: list,
+    ) -> list:
+        files = []
+        need = []
+        for i, spec in enumerate(specs):
+            path = tmpfile.unused("")
+            files.append(processing.File(path, spec["type"], spec.get("digest")))
+            if spec.get("digest") and (blob := self.inputs.get(spec["digest"])):
+                try:
+                    cache.link(blob, path)
+                except FileNotFoundError:
+                    # Evicted since the lookup, so it has to be sent after all.
+                    need.append(i)
+                    continue
+                paths.append(path)
+            else:
+                need.append(i)
+        await remote.send(writer, {"type": "need", "files": need})
+        for i in need:
+            paths.append(files[i].name)
+            digest = await remote.receive_file(reader, specs[i]["size"], files[i].name)
+            if files[i].digest is not None and files[i].digest != digest:
+                raise remote.ProtocolError("Input doesn't match its digest")
+            files[i].digest = digest
+            await asyncio.to_thread(
+                self.inputs.put_file, files[i].name, None, None, digest
+            )
+        return files
+
+    async def send_output(
+        self, writer: asyncio.StreamWriter, out: processing.Output
+    ) -> None:
+        message = {
+            "type": "result",
+            "suffix": out.suffix,
+            "plan": out.plan,
+            "size": out.size,
+        }
+        await remote.send(writer, message)
+        if out.data is not None:
+            writer.write(out.data)
+            await writer.drain()
+        else:
+            await remote.send_file(writer, out.path)
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        paths: list[str] = []
+        try:
+            await remote.send(writer, self.hello())
+            try:
+                job = await remote.receive(reader)
+            except asyncio.IncompleteReadError:
+                # Just polling our load.
+                return
+            if self.token is not None and job.get("token") != self.token:
+                await self.error(writer, "failed", "Bad token")
+                return
+            if job.get("op") not in remote.OPERATIONS:
+                message = f"Unknown operation {job.get('op')}"
+                await self.error(writer, "failed", message)
+                return
+            # A bad job gets an error reply rather than a dropped connection,
+            # which the bot would take as this worker being down and retry
+            # elsewhere.
+            try:
+                files = await self.receive_inputs(reader, writer, job["files"], paths)
+                args = [remote.decode_arg(arg, files) for arg in job["args"]]
+                out = await self.run(reader, job["op"], args, job)
+            except commands.BadArgument as e:
+                await self.error(writer, "bad_argument", str(e))
+                return
+            except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                raise
+            except Exception as e:
+                log.exception("%s failed", job["op"])
+                await self.error(writer, "failed", f"{type(e).__name__}: {e}")
+                return
+            if out.path is not None:
+                paths.append(out.path)
+            await self.send_output(writer, out)
+        except asyncio.TimeoutError:
+            log.warning("%s ran past its deadline", job["op"])
+        except (OSError, asyncio.IncompleteReadError, remote.ProtocolError) as e:
+            log.warning("Connection failed: %r", e)
+        finally:
+            writer.close()
+            for path in paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    async def run(
+        self,
+        reader: asyncio.StreamReader,
+        op: str,
+        args: list,
+        message: dict,
+    ) -> processing.Output:
+        """Runs a job until it's done, the bot hangs up, which is how it
+        cancels one, or its deadline passes."""
+        job = remote.job_from_message(message)
+        timeout = message.get("timeout")
+        token = scheduler.current_job.set(job)
+        try:
+            task = asyncio.ensure_future(getattr(self.processing, op)(*args))
+        finally:
+            scheduler.current_job.reset(token)
+        hangup = asyncio.ensure_future(reader.read(1))
+        try:
+            done, _ = await asyncio.wait(
+                [task, hangup], timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+        finally:
+            hangup.cancel()
+            task.cancel()
+        if task in done:
+            return task.result()
+        if hangup in done:
+            ffutil.scheduler.cancelled("disconnected")
+            raise ConnectionResetError("The bot cancelled the job")
+        ffutil.scheduler.cancelled("deadline")
+        raise asyncio.TimeoutError()
+
+    async def error(
+        self, writer: asyncio.StreamWriter, kind: str, message: str
+    ) -> None:
+        await remote.send(writer, {"type": "error", "kind": kind, "message": message})
+
+
+async def serve(args: argparse.Namespace) -> None:
+    root = os.path.join(tempfile.gettempdir(), "cinnamon", f"worker-{args.port}")
+    ffutil.scheduler.configure(args.max_jobs)
+    executor = pool.WorkerPool(args.workers)
+    executor.start()
+    proc = processing.Processing(
+        executor,
+        asyncio.get_running_loop(),
+        cache.DiskCache(os.path.join(root, "results"), args.cache_bytes),
+        music=musicutil.Music(
+            cache.DiskCache(os.path.join(root, "music"), args.cache_bytes)
+        ),
+        budget=cost.Budget(),
+    )
+    inputs = cache.DiskCache(os.path.join(root, "inputs"), args.cache_bytes)
+    server = Server(proc, inputs, args.token)
+    listener = await asyncio.start_server(server.handle, args.host, args.port)
+    log.info("Listening on %s:%d", args.host, args.port)
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7100)
+    parser.add_argument("--max-jobs", type=int, default=os.cpu_count() or 4)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--cache-bytes", type=int, default=1 << 30)
+    parser.add_argument("--token", default=os.environ.get("CINNAMON_WORKER_TOKEN"))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(serve(args))
+
+
+if __name__ == "__main__":
+    main()